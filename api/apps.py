@@ -0,0 +1,20 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+
+
+class ApiConfig(AppConfig):
+    name = "api"
+
+    def ready(self):
+        from api.config_cache import INVALIDATES, invalidate_config
+        from api.db import apply_sqlite_pragmas
+        from api.metrics import install_db_timer
+        from api.utils import install_query_counter
+
+        for model in INVALIDATES:
+            post_save.connect(invalidate_config, sender=model)
+            post_delete.connect(invalidate_config, sender=model)
+        connection_created.connect(install_db_timer)
+        connection_created.connect(apply_sqlite_pragmas)
+        connection_created.connect(install_query_counter)
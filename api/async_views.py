@@ -0,0 +1,69 @@
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, JsonResponse
+from rest_framework import exceptions
+
+from api.jobs import enqueue_webhook
+from api.utils import measure, query_budget
+from api.views import (
+    authenticate_gitlab_webhook,
+    defer_approve_list,
+    defer_interaction,
+    get_config_message,
+)
+
+logger = logging.getLogger(__name__)
+
+# Async counterparts of api.views used when served by ASGI (ASYNC_VIEWS setting).
+# Outbound calls go through the shared httpx client so the worker doesn't hold
+# a thread per request, ORM calls run through sync_to_async.
+
+
+def async_post_view(view):
+    async def _view(request, *args, **kwargs):
+        if request.method != "POST":
+            return HttpResponseNotAllowed(["POST"])
+        try:
+            return await view(request, *args, **kwargs)
+        except exceptions.ValidationError as e:
+            return JsonResponse(e.detail, status=400, safe=False)
+
+    _view.__name__ = view.__name__
+    # same as api_view, requests come from gitlab & slack, not from a browser
+    _view.csrf_exempt = True
+    return _view
+
+
+@query_budget(3)
+@async_post_view
+@measure
+async def webhooks_gitlab(request):
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        raise exceptions.ValidationError("Malformed JSON payload")
+    gl_mapping = await sync_to_async(authenticate_gitlab_webhook)(request, data)
+    await sync_to_async(enqueue_webhook)(gl_mapping, data)
+    return JsonResponse({"success": True}, status=202)
+
+
+# first call of a user creates their token row within a savepoint
+@query_budget(7)
+@async_post_view
+async def slack_command(request):
+    if request.POST.get("text", "").strip() == "approve":
+        return JsonResponse(defer_approve_list(request.POST))
+    response = await sync_to_async(get_config_message)(
+        request, request.POST.get("team_id"), request.POST.get("user_id")
+    )
+    return JsonResponse(response)
+
+
+@query_budget(0)
+@async_post_view
+async def slack_interactivity(request):
+    payload = json.loads(request.POST.get("payload"))
+    # doesn't block, the work runs on background threads of api.views
+    return JsonResponse(defer_interaction(request, payload))
@@ -0,0 +1,148 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from django.conf import settings
+
+from api.metrics import registry
+from api.models import GitlabRepoChMapping, SlackUser, UserGitlabOAuthToken
+
+# cached kinds that have to be dropped when instance of given model changes,
+# mappings & tokens are cached together with the related rows
+INVALIDATES = {
+    SlackUser: ("slack_user", "oauth_token", "mapping"),
+    UserGitlabOAuthToken: ("oauth_token", "mapping"),
+    GitlabRepoChMapping: ("mapping",),
+}
+
+
+class ConfigCache:
+    """
+    Read-through cache of tenant configuration. Every kind has a version that
+    is bumped by model signals, entries loaded under older version are
+    treated as missing. TTL bounds staleness of changes made by other
+    processes which don't deliver signals here.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, kind, key, loader):
+        with self._lock:
+            version = self._versions.get(kind, 0)
+            entry = self._entries.get((kind, key))
+            if entry is not None:
+                entry_version, expires_at, value = entry
+                if entry_version == version and monotonic() < expires_at:
+                    self._entries.move_to_end((kind, key))
+                    self.hits += 1
+                    return value
+            self.misses += 1
+
+        value = loader()
+        with self._lock:
+            # invalidated while loading, don't store possibly outdated value
+            if self._versions.get(kind, 0) == version:
+                self._entries[(kind, key)] = (version, monotonic() + self.ttl, value)
+                self._entries.move_to_end((kind, key))
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, *kinds):
+        with self._lock:
+            for kind in kinds:
+                self._versions[kind] = self._versions.get(kind, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "size": len(self._entries),
+            }
+
+
+config_cache = ConfigCache(settings.CONFIG_CACHE_MAX_ENTRIES, settings.CONFIG_CACHE_TTL)
+
+
+def get_slack_user(team_id):
+    return config_cache.get_or_load(
+        "slack_user",
+        team_id,
+        lambda: SlackUser.objects.filter(team_id=team_id).first(),
+    )
+
+
+def get_gitlab_oauth_token(slack_user_id, slack_team_id, slack_owner_user):
+    owner_id = slack_owner_user.pk if slack_owner_user else None
+    return config_cache.get_or_load(
+        "oauth_token",
+        (slack_user_id, slack_team_id, owner_id),
+        lambda: UserGitlabOAuthToken.objects.filter(
+            slack_user_id=slack_user_id,
+            slack_team_id=slack_team_id,
+            slack_owner_user=slack_owner_user,
+        ).first(),
+    )
+
+
+def get_repository_mappings(repository_id):
+    return config_cache.get_or_load(
+        "mapping",
+        repository_id,
+        lambda: list(
+            GitlabRepoChMapping.objects.select_related(
+                "gitlab_oauth_token", "slack_user"
+            )
+            .filter(repository_id=repository_id)
+            .order_by("id")
+        ),
+    )
+
+
+def preload_config():
+    """
+    Loads mappings of every repository and their workspaces into the cache
+    """
+    mappings = {}
+    for mapping in GitlabRepoChMapping.objects.select_related(
+        "gitlab_oauth_token", "slack_user"
+    ).order_by("id"):
+        mappings.setdefault(mapping.repository_id, []).append(mapping)
+    for repository_id, repository_mappings in mappings.items():
+        config_cache.get_or_load("mapping", repository_id, lambda: repository_mappings)
+        for mapping in repository_mappings:
+            slack_user = mapping.slack_user
+            config_cache.get_or_load(
+                "slack_user", slack_user.team_id, lambda: slack_user
+            )
+    return len(mappings)
+
+
+def invalidate_config(sender, **kwargs):
+    config_cache.invalidate(*INVALIDATES[sender])
+
+
+registry.counter(
+    "gemrabot_config_cache_lookups_total",
+    "Tenant configuration cache lookups",
+    ["outcome"],
+    collect=lambda: [
+        ({"outcome": "hit"}, config_cache.hits),
+        ({"outcome": "miss"}, config_cache.misses),
+    ],
+)
+registry.gauge(
+    "gemrabot_config_cache_entries",
+    "Entries in tenant configuration cache",
+    collect=lambda: [({}, config_cache.stats()["size"])],
+)
@@ -1,27 +1,28 @@
 from datetime import datetime
 from enum import Enum
+from functools import cached_property
 from typing import Any, List, Optional
 
 from pydantic import BaseModel, AnyHttpUrl
-from unidiff import PatchedFile
 
 
-class PatchedFileRepr(str):
-    def __init__(self, pf: PatchedFile):
-        super().__init__()
-        self.pf = pf
+class DiffStat(str):
+    """
+    Hunks of a single file together with number of added and removed lines.
+    Text is empty when the diff is too big to be shown inline.
+    """
+
+    def __new__(cls, text="", added=0, removed=0):
+        diff_stat = super().__new__(cls, text)
+        diff_stat.added = added
+        diff_stat.removed = removed
+        return diff_stat
 
     def lines_added(self):
-        return self.pf.added
+        return self.added
 
     def lines_removed(self):
-        return self.pf.removed
-
-    def __str__(self):
-        return str(self.pf)
-
-    def __repr__(self):
-        return self.__str__()
+        return self.removed
 
 
 class FileAction(str, Enum):
@@ -37,10 +38,18 @@ class PullRequestStatus(str, Enum):
     closed = "closed"
 
 
+class FetchResource(str, Enum):
+    user = "user"
+    project = "project"
+    merge_request = "merge_request"
+    changes = "changes"
+    approvals = "approvals"
+
+
 class PullRequestFile(BaseModel):
     filename: str
     action: FileAction
-    diff: PatchedFileRepr
+    diff: DiffStat
 
 
 class GitlabMRWebhookUser(BaseModel):
@@ -118,8 +127,43 @@ class GitlabMRWebhook(BaseModel):
     changes: Any
 
 
+class GitlabMRWebhookAttributesView(BaseModel):
+    iid: int
+    target_project_id: int
+    author_id: int
+    state: PullRequestStatus
+    title: str
+    url: str
+
+
+class GitlabMRWebhookView:
+    """
+    Lazily validated merge request hook. Only attributes read by the pipeline
+    are validated (on first access), anything else falls back to the fully
+    validated GitlabMRWebhook.
+    """
+
+    def __init__(self, data: dict):
+        self.data = data
+
+    @cached_property
+    def object_attributes(self) -> GitlabMRWebhookAttributesView:
+        return GitlabMRWebhookAttributesView.parse_obj(
+            self.data.get("object_attributes")
+        )
+
+    @cached_property
+    def webhook(self) -> GitlabMRWebhook:
+        return GitlabMRWebhook.parse_obj(self.data)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name == "data":
+            raise AttributeError(name)
+        return getattr(self.webhook, name)
+
+
 class PullRequest(BaseModel):
-    gitlab_mr_webhook: GitlabMRWebhook
+    gitlab_mr_webhook: GitlabMRWebhookView
     closed_by: Optional[str]
     merged_by: Optional[str]
     author_url: AnyHttpUrl
@@ -128,6 +172,13 @@ class PullRequest(BaseModel):
     approval_count: int
     time_to_merge: int
     changes: List[PullRequestFile] = []
+    files_count: int = 0
+    lines_added: int = 0
+    lines_removed: int = 0
+    inline_diff: bool = True
+
+    class Config:
+        arbitrary_types_allowed = True
 
     @property
     def title(self):
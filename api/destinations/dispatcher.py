@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from time import monotonic
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token and returns how many seconds caller has to wait
+        before it may be used
+        """
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+
+class _PendingCall:
+    def __init__(self, send):
+        self.send = send
+        self.future = Future()
+
+
+class SlackDispatcher:
+    """
+    Paces outbound Slack calls with a token bucket per workspace & method and
+    one per channel, and retries calls answered with 429 after Retry-After.
+    Calls sharing a coalesce key (updates of the same message) that are still
+    waiting for their turn are replaced by the newest one, all callers get the
+    result of the call that was actually made.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, rate, burst):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, burst)
+            return bucket
+
+    def _buckets_for(self, workspace, method, channel):
+        buckets = []
+        if method in settings.SLACK_METHOD_RATE_LIMITS:
+            rate, burst = settings.SLACK_METHOD_RATE_LIMITS[method]
+            buckets.append(self._bucket((workspace, method), rate, burst))
+        if channel is not None and method in settings.SLACK_CHANNEL_RATE_METHODS:
+            rate, burst = settings.SLACK_CHANNEL_RATE_LIMIT
+            buckets.append(self._bucket(("channel", channel), rate, burst))
+        return buckets
+
+    def _reserve(self, buckets):
+        return max([bucket.reserve() for bucket in buckets], default=0)
+
+    def _retry_after(self, buckets, response):
+        if response.status_code != 429:
+            return None
+        retry_after = float(response.headers.get("Retry-After", 1))
+        logger.warning(f"Slack rate limited us, retrying after {retry_after}s")
+        for bucket in buckets:
+            bucket.pause(retry_after)
+        return retry_after
+
+    def _enter(self, coalesce_key, send):
+        """
+        Returns future of already waiting call (which now sends newer payload)
+        or registers a new pending call
+        """
+        with self._lock:
+            pending = self._pending.get(coalesce_key)
+            if pending is not None:
+                logger.info(f"Replaced pending slack call {coalesce_key}")
+                pending.send = send
+                return pending.future, None
+            pending = self._pending[coalesce_key] = _PendingCall(send)
+            return None, pending
+
+    def _leave(self, coalesce_key):
+        with self._lock:
+            return self._pending.pop(coalesce_key)
+
+    def call(self, workspace, method, channel, send, coalesce_key=None):
+        buckets = self._buckets_for(workspace, method, channel)
+        pending = None
+        if coalesce_key is not None:
+            future, pending = self._enter(coalesce_key, send)
+            if future is not None:
+                return future.result()
+        time.sleep(self._reserve(buckets))
+        if pending is not None:
+            send = self._leave(coalesce_key).send
+        try:
+            response = send()
+            for _ in range(settings.SLACK_RATE_LIMIT_RETRIES):
+                if self._retry_after(buckets, response) is None:
+                    break
+                time.sleep(self._reserve(buckets))
+                response = send()
+        except Exception as e:
+            if pending is not None:
+                pending.future.set_exception(e)
+            raise
+        if pending is not None:
+            pending.future.set_result(response)
+        return response
+
+    async def acall(self, workspace, method, channel, send, coalesce_key=None):
+        buckets = self._buckets_for(workspace, method, channel)
+        pending = None
+        if coalesce_key is not None:
+            future, pending = self._enter(coalesce_key, send)
+            if future is not None:
+                return await asyncio.wrap_future(future)
+        await asyncio.sleep(self._reserve(buckets))
+        if pending is not None:
+            send = self._leave(coalesce_key).send
+        try:
+            response = await send()
+            for _ in range(settings.SLACK_RATE_LIMIT_RETRIES):
+                if self._retry_after(buckets, response) is None:
+                    break
+                await asyncio.sleep(self._reserve(buckets))
+                response = await send()
+        except Exception as e:
+            if pending is not None:
+                pending.future.set_exception(e)
+            raise
+        if pending is not None:
+            pending.future.set_result(response)
+        return response
+
+
+dispatcher = SlackDispatcher()
@@ -1,59 +1,137 @@
+import logging
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextvars import copy_context
 from uuid import uuid4
 
-import requests
 from django.conf import settings
-from gitlab import Gitlab, GitlabGetError, GitlabAuthenticationError
-from rest_framework.response import Response
-
-from api.destinations.messages import get_view_add_project, get_view_auth_with_gitlab
+from api.destinations.messages import (
+    get_approve_failed_message,
+    get_bulk_approve_result_message,
+    get_view_add_project,
+    get_view_auth_with_gitlab,
+    get_view_status,
+    with_view_error,
+)
 from api.destinations.slack import SlackClient
+from api.http import get_session
 from api.models import GitlabRepoChMapping, UserGitlabAccessToken, UserGitlabOAuthToken
+from api.sources.gitlab import approve_merge_request, get_current_user, get_gitlab_api
+from api.tokens import get_access_token, with_access_token
+
+logger = logging.getLogger(__name__)
+
+APPROVE_ERRORS = {
+    401: "already approved or not allowed",
+    403: "not allowed",
+    404: "not found",
+}
 
 
 def add_project_to_channel(access_token, trigger_id, response_url):
     client = SlackClient(access_token)
     client.views_open({"trigger_id": trigger_id, "view": get_view_add_project()})
-    requests.post(response_url, json={"delete_original": True})
-    return Response({})
+    get_session(response_url).post(response_url, json={"delete_original": True})
 
 
 def add_gitlab_auth_token(access_token, trigger_id, response_url):
     client = SlackClient(access_token)
     client.views_open({"trigger_id": trigger_id, "view": get_view_auth_with_gitlab()})
-    requests.post(response_url, json={"delete_original": True})
-    return Response({})
+    get_session(response_url).post(response_url, json={"delete_original": True})
+
+
+def update_view(slack_user, payload, view):
+    """
+    Replaces the view the submission came from, it shows progress until then
+    """
+    client = SlackClient(slack_user.access_token)
+    client.views_update({"view_id": payload["view"]["id"], "view": view})
 
 
 def approve_mr_action(
-    action_name, project_id, pull_request_id, gl_auth: UserGitlabOAuthToken
+    action_name,
+    project_id,
+    pull_request_id,
+    gl_auth: UserGitlabOAuthToken,
+    response_url,
 ):
-    gl_client = Gitlab(settings.GITLAB_HOST, oauth_token=gl_auth.gitlab_access_token)
     if action_name == "approve":
-        gl_project = gl_client.projects.get(project_id)
-        gl_mr = gl_project.mergerequests.get(pull_request_id)
-        gl_mr.approve()
-    return Response({})
+        access_token = _get_verified_access_token(gl_auth)
+        error = _approve(access_token, project_id, pull_request_id)
+        if error is not None:
+            get_session(response_url).post(
+                response_url,
+                json=get_approve_failed_message(project_id, pull_request_id, error),
+            )
+
+
+def _get_verified_access_token(gl_auth: UserGitlabOAuthToken):
+    """
+    Returns access token gitlab accepts, refreshing it when it was rejected.
+    401 of approve is no sign of a rejected token, gitlab answers it to
+    approvals of someone who already approved, so the token is checked first.
+    """
+
+    def verify(access_token):
+        get_current_user(access_token)
+        return access_token
+
+    return with_access_token(gl_auth, verify)
+
+
+def _approve(access_token, project_id, pull_request_id):
+    """
+    Returns why the MR wasn't approved, None when it was
+    """
+    try:
+        response = approve_merge_request(access_token, project_id, pull_request_id)
+    except Exception:
+        logger.exception(f"Approval of {project_id}!{pull_request_id} failed")
+        return "GitLab is not reachable"
+    if response.ok:
+        return None
+    # the token was verified, 401 means the user already approved
+    return APPROVE_ERRORS.get(response.status_code, f"failed ({response.status_code})")
+
+
+def approve_all_mr_action(value, gl_auth: UserGitlabOAuthToken, response_url):
+    """
+    Approves MRs listed in button value in parallel, per MR results are
+    sent to the user in one ephemeral message
+    """
+    merge_requests = [
+        item.split("-") for item in value.split(",")[: settings.BULK_APPROVE_MAX_MRS]
+    ]
+    access_token = _get_verified_access_token(gl_auth)
+    with ThreadPoolExecutor(max_workers=settings.BULK_APPROVE_CONCURRENCY) as e:
+        futures = [
+            e.submit(copy_context().run, _approve, access_token, project_id, iid)
+            for project_id, iid in merge_requests
+        ]
+    results = [
+        (project_id, iid, future.result())
+        for (project_id, iid), future in zip(merge_requests, futures)
+    ]
+    get_session(response_url).post(
+        response_url, json=get_bulk_approve_result_message(results)
+    )
 
 
 def view_submission_add_gitlab_user_auth_submit(slack_user, payload):
+    from gitlab import GitlabAuthenticationError
+
     all_values = [v for _, v in payload["view"]["state"]["values"].items()]
     result = {}
     for v in all_values:
         result.update(v)
     private_token = result["add_gitlab_user_auth_token"]["value"]
-    gl_client = Gitlab(settings.GITLAB_HOST, private_token=private_token)
+    gl_client = get_gitlab_api(private_token=private_token)
     try:
         gl_client.auth()
     except GitlabAuthenticationError:
-        return Response(
-            {
-                "response_action": "errors",
-                "errors": {
-                    "personal_access_token_bl": "This token has been marked as invalid by gitlab.com, "
-                    "make sure it is correct"
-                },
-            }
-        )
+        view = get_view_auth_with_gitlab()
+        error = "This token has been marked as invalid by gitlab.com, make sure it is correct"
+        update_view(slack_user, payload, with_view_error(view, error))
+        return
     user = gl_client.user
     slack_person_id = payload["user"]["id"]
     UserGitlabAccessToken.objects.create(
@@ -62,16 +140,15 @@ def view_submission_add_gitlab_user_auth_submit(slack_user, payload):
         gitlab_access_token=private_token,
         slack_user=slack_user,
     )
-    return Response(
-        {
-            "response_action": "clear",
-        }
-    )
+    view = get_view_status("Gitlab Auth", f"Connected as *{user.name}*")
+    update_view(slack_user, payload, view)
 
 
 def view_submission_add_gl_project_to_ch_submit(
     slack_user, payload, gitlab_webhook_uri
 ):
+    from gitlab import GitlabGetError
+
     all_values = [v for _, v in payload["view"]["state"]["values"].items()]
     result = {}
     for v in all_values:
@@ -84,30 +161,49 @@ def view_submission_add_gl_project_to_ch_submit(
         slack_team_id=payload["team"]["id"],
     )
 
-    gl_client = Gitlab(settings.GITLAB_HOST, oauth_token=gl_oauth.gitlab_access_token)
+    gl_client = get_gitlab_api(oauth_token=get_access_token(gl_oauth))
     try:
         gl_project = gl_client.projects.get(project_id)
     except GitlabGetError:
-        return Response(
+        error = (
+            "This project doesn't exist in gitlab.com for your access key\n"
+            "Can be either numeric ID or full project path 'group_name/project_name'"
+        )
+        update_view(slack_user, payload, with_view_error(get_view_add_project(), error))
+        return
+    existing_mappings = GitlabRepoChMapping.objects.filter(
+        repository_id=gl_project.id
+    ).order_by("id")
+    if any(mapping.channel_id == channel_id for mapping in existing_mappings):
+        error = "This project is already posting to selected channel"
+        update_view(slack_user, payload, with_view_error(get_view_add_project(), error))
+        return
+    # the hook of a project is shared only within a workspace, its data is
+    # fetched with the tokens of that workspace
+    hooked_mapping = next(
+        (
+            mapping
+            for mapping in existing_mappings
+            if mapping.webhook_id and mapping.slack_user_id == slack_user.id
+        ),
+        None,
+    )
+    if hooked_mapping:
+        # one hook per project, every channel of the project is notified by it
+        secret_token = hooked_mapping.webhook_secret
+        hook_id = hooked_mapping.webhook_id
+    else:
+        secret_token = str(uuid4())
+        hook = gl_project.hooks.create(
             {
-                "response_action": "errors",
-                "errors": {
-                    "project_id_bl": "This project doesn't exist in gitlab.com for your access key\n"
-                    "Can be either numeric ID or full project path 'group_name/project_name'"
-                },
+                "merge_requests_events": True,
+                "push_events": False,
+                "enable_ssl_verification": True,
+                "token": secret_token,
+                "url": gitlab_webhook_uri,
             }
         )
-    secret_token = str(uuid4())
-    hook = gl_project.hooks.create(
-        {
-            "merge_requests_events": True,
-            "push_events": False,
-            "enable_ssl_verification": True,
-            "token": secret_token,
-            "url": gitlab_webhook_uri,
-        }
-    )
-    # throw error if such combination already exists
+        hook_id = hook.id
     GitlabRepoChMapping.objects.create(
         slack_user=slack_user,
         channel_id=channel_id,
@@ -115,11 +211,9 @@ def view_submission_add_gl_project_to_ch_submit(
         repository_name=gl_project.name,
         gitlab_oauth_token=gl_oauth,
         webhook_secret=secret_token,
-        webhook_id=hook.id,
+        webhook_id=hook_id,
     )
-
-    return Response(
-        {
-            "response_action": "clear",
-        }
+    view = get_view_status(
+        "Add project", f"Project *{gl_project.name}* now posts to <#{channel_id}>"
     )
+    update_view(slack_user, payload, view)
@@ -1,10 +1,16 @@
 from datetime import timedelta
 from typing import List
 
-from api.data_models import PullRequestFile
+from django.conf import settings
+
+from api.data_models import FetchResource, PullRequest, PullRequestStatus
 from api.models import GitlabRepoChMapping, UserGitlabOAuthToken
 from api.utils import td_format
 
+# slack rejects messages with more blocks or longer section texts
+SLACK_MAX_BLOCKS = 50
+SLACK_MAX_TEXT_LENGTH = 3000
+
 
 def get_closed_message(pull_request):
     return {
@@ -38,48 +44,68 @@ def get_merged_message(pull_request):
     }
 
 
-def _get_files_message(changes: List[PullRequestFile]):
+class BlockBudget:
+    """
+    Room left in a message for more blocks and characters of their texts
+    """
+
+    def __init__(self, blocks, chars):
+        self.blocks = blocks
+        self.chars = chars
+
+    def take(self, blocks, chars):
+        if blocks > self.blocks or chars > self.chars:
+            return False
+        self.blocks -= blocks
+        self.chars -= chars
+        return True
+
+
+def _section(text):
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
+
+def _get_file_text(change, inline, max_length):
+    if not inline:
+        text = (
+            f"*Filename:* {change.filename} "
+            f":heavy_plus_sign:: {change.diff.lines_added()} / "
+            f":heavy_minus_sign:: {change.diff.lines_removed()}"
+        )
+        return text if len(text) <= max_length else None
+    head = f"*Filename:* {change.filename}\n```"
+    room = max_length - len(head) - len("\n…```")
+    if room <= 0:
+        return None
+    hunks = change.diff.rstrip("\n")
+    if len(hunks) > room:
+        # cut at line end, hunk text is shown as is otherwise
+        hunks = hunks[:room].rsplit("\n", 1)[0] + "\n…"
+    return f"{head}{hunks}```"
+
+
+def _get_files_message(pull_request: PullRequest, budget: BlockBudget):
+    """
+    Renders files one by one while they fit into the budget, files left out
+    are mentioned only by count
+    """
+    changes = pull_request.changes
+    if not pull_request.inline_diff:
+        changes = changes[: settings.SUMMARY_MAX_FILES]
     changes_list = []
-    all_added = sum([x.diff.lines_added() for x in changes])
-    all_removed = sum([x.diff.lines_removed() for x in changes])
-    if all_added + all_removed > 20:
-        for change in changes[:10]:
-            changes_list.append({"type": "divider"})
-            changes_list.append(
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": f"*Filename:* {change.filename} "
-                        f":heavy_plus_sign:: {change.diff.lines_added()} / "
-                        f":heavy_minus_sign:: {change.diff.lines_removed()}",
-                    },
-                }
-            )
-        if len(changes) > 10:
-            changes_list.append({"type": "divider"})
-            changes_list.append(
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": f"And {len(changes) - 10} more files...",
-                    },
-                }
-            )
-    else:
-        for change in changes:
-            changes_list.append({"type": "divider"})
-            fmt_message = "\n".join(change.diff.split("\n")[4:])
-            changes_list.append(
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": f"*Filename:* {change.filename}\n```{fmt_message}```",
-                    },
-                }
-            )
+    rendered = 0
+    for change in changes:
+        max_length = min(SLACK_MAX_TEXT_LENGTH, budget.chars)
+        text = _get_file_text(change, pull_request.inline_diff, max_length)
+        if text is None or not budget.take(2, len(text)):
+            break
+        changes_list.append({"type": "divider"})
+        changes_list.append(_section(text))
+        rendered += 1
+    if pull_request.files_count > rendered:
+        more_files = pull_request.files_count - rendered
+        changes_list.append({"type": "divider"})
+        changes_list.append(_section(f"And {more_files} more files..."))
     return changes_list
 
 
@@ -93,8 +119,9 @@ def get_opened_message(pull_request):
         },
     }
     blocks = [headline]
-    for m in _get_files_message(pull_request.changes):
-        blocks.append(m)
+    # headline, buttons, approvals and the note about files left out
+    budget = BlockBudget(SLACK_MAX_BLOCKS - 5, settings.SLACK_MESSAGE_MAX_CHARS)
+    blocks.extend(_get_files_message(pull_request, budget))
     blocks.append(
         {
             "type": "actions",
@@ -128,6 +155,87 @@ def get_opened_message(pull_request):
     return {"blocks": blocks}
 
 
+# gitlab resources read by message of given MR state
+MESSAGE_RESOURCES = {
+    PullRequestStatus.opened: {
+        FetchResource.user,
+        FetchResource.changes,
+        FetchResource.approvals,
+    },
+    PullRequestStatus.closed: {FetchResource.user},
+    PullRequestStatus.merged: {FetchResource.user},
+}
+
+
+def get_approve_list_message(merge_requests):
+    if not merge_requests:
+        return {
+            "blocks": [
+                _section("There are no open merge requests in this channel right now")
+            ]
+        }
+    blocks = [_section(f"Open merge requests ({len(merge_requests)}):")]
+    for mr in merge_requests:
+        blocks.append(
+            _section(f"- *<{mr['web_url']}|{mr['title']}>* by {mr['author']['name']}")
+        )
+    blocks.append(
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "action_id": "approve_all_mr_action",
+                    "text": {"type": "plain_text", "text": "Approve all listed"},
+                    "style": "primary",
+                    "value": ",".join(
+                        f"{mr['project_id']}-{mr['iid']}" for mr in merge_requests
+                    ),
+                    "confirm": {
+                        "title": {"type": "plain_text", "text": "Approve all?"},
+                        "text": {
+                            "type": "plain_text",
+                            "text": f"{len(merge_requests)} merge requests will be approved",
+                        },
+                        "confirm": {"type": "plain_text", "text": "Approve"},
+                        "deny": {"type": "plain_text", "text": "Cancel"},
+                    },
+                }
+            ],
+        }
+    )
+    return {"blocks": blocks}
+
+
+def get_approve_failed_message(project_id, iid, error):
+    return {
+        "replace_original": False,
+        "response_type": "ephemeral",
+        "text": f"Merge request {project_id}!{iid} wasn't approved: {error}",
+    }
+
+
+def get_bulk_approve_result_message(results):
+    """
+    `results` are (project id, MR iid, error or None) of every approval
+    """
+    lines = [
+        f"{':white_check_mark:' if error is None else ':x:'} "
+        f"{project_id}!{iid}{'' if error is None else f': {error}'}"
+        for project_id, iid, error in results
+    ]
+    approved = sum(error is None for _, _, error in results)
+    return {
+        "replace_original": False,
+        "response_type": "ephemeral",
+        "text": f"Approved {approved} of {len(results)} merge requests",
+        "blocks": [
+            _section(f"Approved {approved} of {len(results)} merge requests"),
+            _section("\n".join(lines)[:SLACK_MAX_TEXT_LENGTH]),
+        ],
+    }
+
+
 def _get_config_buttons():
     return {
         "type": "actions",
@@ -208,14 +316,41 @@ def get_config_empty_message():
     }
 
 
-def get_config_project_list(gl_mappings: List[GitlabRepoChMapping]):
+def _get_config_pages_buttons(page, pages):
+    elements = []
+    if page > 0:
+        elements.append(
+            {
+                "type": "button",
+                "action_id": "config_projects_page",
+                "value": str(page - 1),
+                "text": {"type": "plain_text", "text": "Previous"},
+            }
+        )
+    if page < pages - 1:
+        elements.append(
+            {
+                "type": "button",
+                "action_id": "config_projects_page",
+                "value": str(page + 1),
+                "text": {"type": "plain_text", "text": "Next"},
+            }
+        )
+    return {"type": "actions", "elements": elements}
+
+
+def get_config_project_list(
+    gl_mappings: List[GitlabRepoChMapping], total, page=0, page_size=None
+):
+    page_size = page_size or max(total, 1)
+    pages = (total + page_size - 1) // page_size
     result = {
         "blocks": [
             {
                 "type": "section",
                 "text": {
                     "type": "mrkdwn",
-                    "text": f"You have {len(gl_mappings)} project connected: ",
+                    "text": f"You have {total} project connected: ",
                 },
             }
         ]
@@ -231,10 +366,37 @@ def get_config_project_list(gl_mappings: List[GitlabRepoChMapping]):
                 },
             }
         )
+    if pages > 1:
+        result["blocks"].append(
+            {
+                "type": "context",
+                "elements": [
+                    {"type": "plain_text", "text": f"Page {page + 1} of {pages}"}
+                ],
+            }
+        )
+        result["blocks"].append(_get_config_pages_buttons(page, pages))
     result["blocks"].append(_get_config_buttons())
     return result
 
 
+def get_view_status(title, text):
+    """
+    Modal without inputs telling user how their submission went
+    """
+    return {
+        "title": {"type": "plain_text", "text": title, "emoji": True},
+        "type": "modal",
+        "close": {"type": "plain_text", "text": "Close", "emoji": True},
+        "blocks": [_section(text)],
+    }
+
+
+def with_view_error(view, error):
+    view["blocks"].insert(0, _section(f":warning: {error}"))
+    return view
+
+
 def get_view_auth_with_gitlab():
     return {
         "title": {"type": "plain_text", "text": "Gitlab Auth", "emoji": True},
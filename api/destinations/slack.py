@@ -1,48 +1,118 @@
-import requests
+import asyncio
+import hashlib
+import json
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import timedelta
+from typing import List, Optional
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 from requests import exceptions as requests_exc, RequestException
 
 from api.data_models import PullRequest, PullRequestStatus
+from api.destinations.dispatcher import dispatcher
 from api.destinations.messages import (
+    MESSAGE_RESOURCES,
     get_closed_message,
     get_merged_message,
     get_opened_message,
 )
+from api.http import get_async_client, get_session
+from api.metrics import slack_call_seconds, slack_updates_skipped, stage_seconds
 from api.models import PrMessage
+from api.resilience import acall, call
 
 
 class SlackClient:
     def __init__(self, access_token):
         self.access_token = access_token
-        self.session = requests.Session()
-        self.session.headers.update(
-            {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json; charset=utf-8",
-            }
-        )
+        self.session = get_session(settings.SLACK_API_URL)
+        self.headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json; charset=utf-8",
+        }
 
-    def _json_post(self, url, **kwargs):
-        response = self.session.post(url, **kwargs)
+    @staticmethod
+    def _read_json(response):
         response.raise_for_status()
         json = response.json()
         if not json["ok"]:
             raise requests_exc.RequestException(json)
         return json
 
+    def _json_post(self, method, coalesce_key=None, **kwargs):
+        url = f"{settings.SLACK_API_URL}/{method}"
+        channel = kwargs.get("json", {}).get("channel")
+
+        def send():
+            with slack_call_seconds.time(method=method):
+                return self.session.post(
+                    url, headers=self.headers, timeout=settings.HTTP_TIMEOUT, **kwargs
+                )
+
+        # posts aren't idempotent, they only go through the circuit breaker
+        response = dispatcher.call(
+            self.access_token, method, channel, lambda: call(url, send), coalesce_key
+        )
+        return self._read_json(response)
+
+    async def _ajson_post(self, method, coalesce_key=None, **kwargs):
+        url = f"{settings.SLACK_API_URL}/{method}"
+        channel = kwargs.get("json", {}).get("channel")
+
+        async def send():
+            with slack_call_seconds.time(method=method):
+                return await get_async_client().post(
+                    url, headers=self.headers, **kwargs
+                )
+
+        response = await dispatcher.acall(
+            self.access_token, method, channel, lambda: acall(url, send), coalesce_key
+        )
+        return self._read_json(response)
+
     def post_message(self, json):
-        return self._json_post("https://slack.com/api/chat.postMessage", json=json)
+        return self._json_post("chat.postMessage", json=json)
 
     def update_message(self, json):
-        return self._json_post("https://slack.com/api/chat.update", json=json)
+        # only the newest content matters, older waiting updates are dropped
+        coalesce_key = ("chat.update", json["channel"], json["ts"])
+        return self._json_post("chat.update", coalesce_key, json=json)
 
     def views_open(self, json):
-        return self._json_post("https://slack.com/api/views.open", json=json)
+        return self._json_post("views.open", json=json)
+
+    def views_update(self, json):
+        return self._json_post("views.update", json=json)
+
+    async def apost_message(self, json):
+        return await self._ajson_post("chat.postMessage", json=json)
+
+    async def aupdate_message(self, json):
+        coalesce_key = ("chat.update", json["channel"], json["ts"])
+        return await self._ajson_post("chat.update", coalesce_key, json=json)
+
+    async def aviews_open(self, json):
+        return await self._ajson_post("views.open", json=json)
+
+
+def get_slack_error(exception: RequestException) -> Optional[str]:
+    """
+    Returns the error code of a Slack API response rejected by SlackClient,
+    None for HTTP & connection errors
+    """
+    response = exception.args[0] if exception.args else None
+    if isinstance(response, dict):
+        return response.get("error")
+    return None
 
 
 def slack_oauth_request(code):
-    response = requests.post(
-        "https://slack.com/api/oauth.v2.access",
+    response = get_session(settings.SLACK_API_URL).post(
+        f"{settings.SLACK_API_URL}/oauth.v2.access",
         {
             "code": code,
             "client_id": settings.SLACK_CLIENT_ID,
@@ -61,6 +131,10 @@ class SlackNotifier:
         self.slack_client = SlackClient(slack_access_token)
         self.channel_id = channel_id
 
+    @staticmethod
+    def get_required_resources(state: PullRequestStatus):
+        return MESSAGE_RESOURCES[state]
+
     @staticmethod
     def get_slack_message(pull_request):
         func_mapper = {
@@ -68,24 +142,46 @@ class SlackNotifier:
             PullRequestStatus.closed: get_closed_message,
             PullRequestStatus.merged: get_merged_message,
         }
-        return func_mapper[pull_request.state](pull_request)
+        with stage_seconds.time(stage="render"):
+            return func_mapper[pull_request.state](pull_request)
 
     def notify_of_pull_request(self, pull_request: PullRequest):
-        message = self.get_slack_message(pull_request)
-
-        pr_message = PrMessage.objects.filter(
-            pr_id=pull_request.id, repository_id=pull_request.repository_id
-        ).first()
-        if not pr_message:
-            self.create_message(message, pull_request)
-        else:
+        notify_channels([self], pull_request)
+
+    @staticmethod
+    def get_blocks_hash(message):
+        blocks = json.dumps(message["blocks"], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(blocks.encode()).hexdigest()
+
+    def is_unchanged(self, pr_message, blocks_hash):
+        if pr_message.blocks_hash != blocks_hash:
+            return False
+        slack_updates_skipped.inc()
+        return True
+
+    def deliver(self, message, blocks_hash, pr_message: PrMessage):
+        """
+        Posts the message when `pr_message` is a fresh claim, otherwise updates
+        the posted message (unless its blocks didn't change). Returns
+        `pr_message` when it has to be saved.
+        """
+        if pr_message.is_posted:
+            if self.is_unchanged(pr_message, blocks_hash):
+                return None
             try:
                 self.update_message(message, pr_message)
+                pr_message.blocks_hash = blocks_hash
+                return pr_message
             except RequestException as e:
-                response = e.args[0]
-                if response["error"] == "message_not_found":
-                    pr_message.delete()
-                    self.create_message(message, pull_request)
+                error = get_slack_error(e)
+                if error is None:
+                    raise
+                if error != "message_not_found":
+                    return None
+        response = self.create_message(message)
+        pr_message.message_ts = response["ts"]
+        pr_message.blocks_hash = blocks_hash
+        return pr_message
 
     def update_message(self, message, pr_message):
         self.slack_client.update_message(
@@ -96,15 +192,179 @@ class SlackNotifier:
             }
         )
 
-    def create_message(self, message, pull_request):
-        response = self.slack_client.post_message(
+    def create_message(self, message):
+        return self.slack_client.post_message(
+            {"channel": self.channel_id, "blocks": message["blocks"]}
+        )
+
+    async def anotify_of_pull_request(self, pull_request: PullRequest):
+        await anotify_channels([self], pull_request)
+
+    async def adeliver(self, message, blocks_hash, pr_message: PrMessage):
+        if pr_message.is_posted:
+            if self.is_unchanged(pr_message, blocks_hash):
+                return None
+            try:
+                await self.aupdate_message(message, pr_message)
+                pr_message.blocks_hash = blocks_hash
+                return pr_message
+            except RequestException as e:
+                error = get_slack_error(e)
+                if error is None:
+                    raise
+                if error != "message_not_found":
+                    return None
+        response = await self.acreate_message(message)
+        pr_message.message_ts = response["ts"]
+        pr_message.blocks_hash = blocks_hash
+        return pr_message
+
+    async def aupdate_message(self, message, pr_message):
+        await self.slack_client.aupdate_message(
+            {
+                "channel": pr_message.message_channel,
+                "ts": pr_message.message_ts,
+                "blocks": message["blocks"],
+            }
+        )
+
+    async def acreate_message(self, message):
+        return await self.slack_client.apost_message(
             {"channel": self.channel_id, "blocks": message["blocks"]}
         )
-        channel = response["channel"]
-        ts = response["ts"]
-        PrMessage.objects.create(
-            message_channel=channel,
-            message_ts=ts,
+
+
+class MessageClaimedError(Exception):
+    """
+    Another worker is posting the message to the channel right now
+    """
+
+
+def _claim_pr_message(pull_request: PullRequest, channel):
+    try:
+        with transaction.atomic():
+            return PrMessage.objects.create(
+                message_channel=channel,
+                message_ts="",
+                pr_id=pull_request.id,
+                repository_id=pull_request.repository_id,
+                claimed_at=timezone.now(),
+            )
+    except IntegrityError:
+        return MessageClaimedError(f"Message in {channel} is claimed by other worker")
+
+
+def _take_over_claim(pr_message: PrMessage):
+    """
+    Claims of workers that died before posting are taken over after the
+    job lease time
+    """
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=settings.JOB_LEASE_SECONDS)
+    taken_over = PrMessage.objects.filter(
+        pk=pr_message.pk, message_ts="", claimed_at__lt=stale_before
+    ).update(claimed_at=now)
+    if not taken_over:
+        return MessageClaimedError(
+            f"Message in {pr_message.message_channel} is claimed by other worker"
+        )
+    return pr_message
+
+
+def claim_pr_messages(pull_request: PullRequest, notifiers: List[SlackNotifier]):
+    """
+    Returns PrMessage of the MR for every channel. Channels without one get a
+    claim row (no ts yet) inserted, the unique constraint makes sure only one
+    worker posts the message. Channels claimed by other workers map to
+    MessageClaimedError, their job is retried once the message is posted.
+    """
+    pr_messages = {
+        pr_message.message_channel: pr_message
+        for pr_message in PrMessage.objects.filter(
             pr_id=pull_request.id,
             repository_id=pull_request.repository_id,
+            message_channel__in=[notifier.channel_id for notifier in notifiers],
         )
+    }
+    for notifier in notifiers:
+        pr_message = pr_messages.get(notifier.channel_id)
+        if pr_message is None:
+            pr_message = _claim_pr_message(pull_request, notifier.channel_id)
+        elif not pr_message.is_posted:
+            pr_message = _take_over_claim(pr_message)
+        pr_messages[notifier.channel_id] = pr_message
+    return pr_messages
+
+
+def store_pr_messages(deliveries):
+    """
+    Saves posted & updated messages, releases claims of messages that failed
+    to be posted and re-raises errors of failed channels. `deliveries` are
+    (PrMessage or claim error, delivery result or error) pairs.
+    """
+    saved = [result for _, result in deliveries if isinstance(result, PrMessage)]
+    if saved:
+        PrMessage.objects.bulk_update(saved, ["message_ts", "blocks_hash"])
+    released = [
+        pr_message.pk
+        for pr_message, result in deliveries
+        if isinstance(result, Exception)
+        and isinstance(pr_message, PrMessage)
+        and not pr_message.is_posted
+    ]
+    if released:
+        PrMessage.objects.filter(pk__in=released, message_ts="").delete()
+    # messages that were posted are stored first so a retry updates them
+    # instead of posting duplicates
+    for _, result in deliveries:
+        if isinstance(result, Exception):
+            raise result
+
+
+def notify_channels(notifiers: List[SlackNotifier], pull_request: PullRequest):
+    """
+    Renders the message once and posts or updates it in every channel
+    in parallel
+    """
+    message = SlackNotifier.get_slack_message(pull_request)
+    blocks_hash = SlackNotifier.get_blocks_hash(message)
+    pr_messages = claim_pr_messages(pull_request, notifiers)
+
+    def deliver(notifier):
+        pr_message = pr_messages[notifier.channel_id]
+        if isinstance(pr_message, MessageClaimedError):
+            raise pr_message
+        return notifier.deliver(message, blocks_hash, pr_message)
+
+    with ThreadPoolExecutor(max_workers=len(notifiers)) as e:
+        futures = [
+            e.submit(copy_context().run, deliver, notifier) for notifier in notifiers
+        ]
+    store_pr_messages(
+        [
+            (pr_messages[notifier.channel_id], future.exception() or future.result())
+            for notifier, future in zip(notifiers, futures)
+        ]
+    )
+
+
+async def anotify_channels(notifiers: List[SlackNotifier], pull_request: PullRequest):
+    message = SlackNotifier.get_slack_message(pull_request)
+    blocks_hash = SlackNotifier.get_blocks_hash(message)
+    pr_messages = await sync_to_async(claim_pr_messages)(pull_request, notifiers)
+
+    async def deliver(notifier):
+        pr_message = pr_messages[notifier.channel_id]
+        if isinstance(pr_message, MessageClaimedError):
+            raise pr_message
+        return await notifier.adeliver(message, blocks_hash, pr_message)
+
+    results = await asyncio.gather(
+        *[deliver(notifier) for notifier in notifiers], return_exceptions=True
+    )
+    await sync_to_async(store_pr_messages)(
+        [
+            (pr_messages[notifier.channel_id], result)
+            for notifier, result in zip(notifiers, results)
+        ]
+    )
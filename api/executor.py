@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextvars import copy_context
+from time import perf_counter_ns
+from typing import Hashable
+
+from api.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+deferred_tasks = registry.counter(
+    "gemrabot_deferred_tasks_total",
+    "Tasks submitted to background executor",
+    ["outcome"],
+)
+lane_depth = registry.gauge(
+    "gemrabot_lane_depth", "Tasks queued or running in executor lane", ["lane"]
+)
+lane_wait_seconds = registry.histogram(
+    "gemrabot_lane_wait_seconds", "Time task waited in its lane before it started"
+)
+
+_STOP = object()
+
+
+class PartitionedExecutor:
+    """
+    Runs tasks on a fixed number of lanes, each lane is a thread working
+    through its own queue in order. Tasks with the same key always land on
+    the same lane, so they run strictly one after another while tasks of
+    different keys run in parallel.
+    """
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self._queues = [queue.SimpleQueue() for _ in range(lanes)]
+        self._threads = [
+            threading.Thread(target=self._work, args=(lane,), daemon=True)
+            for lane in range(lanes)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def lane_of(self, key: Hashable):
+        return hash(key) % self.lanes
+
+    def submit(self, key: Hashable, fn, *args, **kwargs) -> Future:
+        lane = self.lane_of(key)
+        future = Future()
+        lane_depth.inc(lane=lane)
+        self._queues[lane].put((perf_counter_ns(), future, fn, args, kwargs))
+        return future
+
+    def _work(self, lane):
+        while True:
+            task = self._queues[lane].get()
+            if task is _STOP:
+                return
+            submitted_at, future, fn, args, kwargs = task
+            lane_wait_seconds.observe_ns(perf_counter_ns() - submitted_at)
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            lane_depth.dec(lane=lane)
+
+    def shutdown(self, wait=True):
+        """
+        Lets lanes finish tasks that were already submitted and stops them
+        """
+        for lane_queue in self._queues:
+            lane_queue.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class AsyncPartitionedExecutor:
+    """
+    PartitionedExecutor for coroutines, lanes are tasks of the running loop
+    """
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self._queues = [asyncio.Queue() for _ in range(lanes)]
+        self._tasks = [asyncio.ensure_future(self._work(lane)) for lane in range(lanes)]
+
+    def lane_of(self, key: Hashable):
+        return hash(key) % self.lanes
+
+    def submit(self, key: Hashable, coroutine_fn, *args, **kwargs) -> asyncio.Future:
+        lane = self.lane_of(key)
+        future = asyncio.get_running_loop().create_future()
+        lane_depth.inc(lane=lane)
+        self._queues[lane].put_nowait(
+            (perf_counter_ns(), future, coroutine_fn, args, kwargs)
+        )
+        return future
+
+    async def _work(self, lane):
+        while True:
+            task = await self._queues[lane].get()
+            if task is _STOP:
+                return
+            submitted_at, future, coroutine_fn, args, kwargs = task
+            lane_wait_seconds.observe_ns(perf_counter_ns() - submitted_at)
+            if not future.cancelled():
+                try:
+                    future.set_result(await coroutine_fn(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+            lane_depth.dec(lane=lane)
+
+    async def shutdown(self):
+        for lane_queue in self._queues:
+            lane_queue.put_nowait(_STOP)
+        await asyncio.gather(*self._tasks)
+
+
+class DeduplicatingExecutor:
+    """
+    Runs tasks on `workers` background threads with at most `max_pending`
+    tasks queued or running. Tasks submitted with the key of a pending task
+    are dropped, as are tasks submitted while the executor is full.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="deferred"
+        )
+        self._pending = set()
+        self._idle = threading.Condition()
+
+    def submit(self, key: Hashable, fn, *args, **kwargs) -> str:
+        """
+        Returns outcome of the submission: accepted, duplicate or rejected
+        """
+        with self._idle:
+            if key in self._pending:
+                outcome = "duplicate"
+            elif len(self._pending) >= self.max_pending:
+                outcome = "rejected"
+            else:
+                outcome = "accepted"
+                self._pending.add(key)
+        deferred_tasks.inc(outcome=outcome)
+        if outcome == "accepted":
+            # context is copied so the task is attributed to the tenant
+            self._executor.submit(copy_context().run, self._run, key, fn, args, kwargs)
+        return outcome
+
+    def _run(self, key, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            logger.exception(f"Deferred task {key} failed")
+        finally:
+            with self._idle:
+                self._pending.discard(key)
+                self._idle.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Waits until there are no pending tasks, False when timeout ran out
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
@@ -0,0 +1,89 @@
+import asyncio
+import http.cookiejar
+import threading
+import weakref
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from api.metrics import count_outbound_request
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _origin(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _cookie_jar():
+    # shared sessions serve every tenant, a cookie set for one of them would
+    # be sent along with the requests of the others
+    return http.cookiejar.CookieJar(
+        policy=http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+    )
+
+
+def _new_session(origin):
+    session = requests.Session()
+    session.cookies = _cookie_jar()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+    session.mount(f"{origin}/", adapter)
+    host = urlsplit(origin).hostname
+    session.hooks["response"].append(
+        lambda response, *args, **kwargs: count_outbound_request(
+            host, response.status_code
+        )
+    )
+    return session
+
+
+async def _count_async_response(response):
+    count_outbound_request(response.request.url.host, response.status_code)
+
+
+def get_session(url) -> requests.Session:
+    """
+    Returns keep-alive session shared by every caller talking to the host of
+    given url. Sessions carry no credentials and store no cookies, auth
+    headers have to be passed with each request.
+    """
+    origin = _origin(url)
+    with _sessions_lock:
+        session = _sessions.get(origin)
+        if session is None:
+            session = _sessions[origin] = _new_session(origin)
+            # least recently used hosts (mostly one-off response_url hosts)
+            # are dropped, connections get closed once no one holds them
+            while len(_sessions) > settings.HTTP_POOL_MAX_HOSTS:
+                _sessions.popitem(last=False)
+        else:
+            _sessions.move_to_end(origin)
+        return session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns pooled async client of the running event loop, the client keeps
+    keep-alive connections to every host it talks to. As with the sessions
+    auth headers are passed with each request.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            timeout=settings.HTTP_TIMEOUT,
+            cookies=_cookie_jar(),
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_POOL_MAXSIZE,
+            ),
+            event_hooks={"response": [_count_async_response]},
+        )
+    return client
@@ -0,0 +1,245 @@
+import json
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Count, Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from api.data_models import GitlabMRWebhookView
+from api.config_cache import get_repository_mappings
+from api.destinations.slack import SlackNotifier, anotify_channels, notify_channels
+from api.metrics import current_tenant, registry
+from api.models import GitlabRepoChMapping, WebhookJob
+from api.resilience import CircuitOpenError
+from api.sources.gitlab import GitlabMergeRequest
+from api.tokens import awith_access_token, with_access_token
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_webhook(gl_mapping: GitlabRepoChMapping, payload: dict):
+    """
+    Events for the same merge request arriving within the coalesce window
+    replace the payload of the job that is still waiting, so a burst of
+    updates ends up as a single fetch & render pass with the newest state.
+    Only events of the same hook are coalesced, repositories with a hook per
+    channel keep a job per hook so every channel is notified.
+    """
+    attributes = payload["object_attributes"]
+    repository_id = attributes["target_project_id"]
+    pr_id = attributes["iid"]
+    now = timezone.now()
+    coalesced = WebhookJob.objects.filter(
+        repository_id=repository_id,
+        pr_id=pr_id,
+        gl_mapping__webhook_secret=gl_mapping.webhook_secret,
+        status=WebhookJob.Status.pending,
+    ).update(payload=json.dumps(payload), updated_at=now)
+    if coalesced:
+        logger.info(f"Coalesced webhook for MR {repository_id}!{pr_id}")
+        return
+    WebhookJob.objects.create(
+        gl_mapping=gl_mapping,
+        repository_id=repository_id,
+        pr_id=pr_id,
+        payload=json.dumps(payload),
+        run_after=now + timedelta(seconds=settings.WEBHOOK_COALESCE_WINDOW),
+    )
+
+
+def _claimable(now):
+    return Q(status=WebhookJob.Status.pending, run_after__lte=now) | Q(
+        status=WebhookJob.Status.running, locked_until__lt=now
+    )
+
+
+def claimable_jobs(now, worker_id=""):
+    """
+    Jobs of a merge request that has a job running in another worker wait
+    until it finishes, the worker running it would otherwise race with this
+    one. A worker queues jobs of its own merge requests on the same lane.
+    """
+    busy = WebhookJob.objects.filter(
+        repository_id=OuterRef("repository_id"),
+        pr_id=OuterRef("pr_id"),
+        status=WebhookJob.Status.running,
+        locked_until__gte=now,
+    ).exclude(locked_by=worker_id)
+    return WebhookJob.objects.filter(_claimable(now)).filter(~Exists(busy))
+
+
+def claim_next_job(worker_id="") -> Optional[WebhookJob]:
+    """
+    Picks the oldest runnable job and marks it as running for the lease time.
+    Running jobs whose lease expired (crashed worker) are picked up again.
+    """
+    now = timezone.now()
+    candidates = (
+        claimable_jobs(now, worker_id)
+        .order_by("run_after", "id")
+        .values_list("id", flat=True)[:10]
+    )
+    for job_id in candidates:
+        claimed = (
+            claimable_jobs(now, worker_id)
+            .filter(id=job_id)
+            .update(
+                status=WebhookJob.Status.running,
+                locked_until=now + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+                locked_by=worker_id,
+                attempts=F("attempts") + 1,
+                updated_at=now,
+            )
+            > 0
+        )
+        if claimed:
+            return WebhookJob.objects.select_related(
+                "gl_mapping__gitlab_oauth_token", "gl_mapping__slack_user"
+            ).get(id=job_id)
+    return None
+
+
+def get_channel_mappings(gl_mapping: GitlabRepoChMapping):
+    """
+    Mappings of all channels notified by the webhook. Channels added to a
+    repository share its webhook secret, repositories that still have a hook
+    per channel notify only the channel of the hook that was called.
+    """
+    return [
+        mapping
+        for mapping in get_repository_mappings(gl_mapping.repository_id)
+        if mapping.webhook_secret == gl_mapping.webhook_secret
+    ] or [gl_mapping]
+
+
+def _prepare_webhook(gl_mapping: GitlabRepoChMapping, payload: dict):
+    gitlab_mr_webhook = GitlabMRWebhookView(payload)
+    # access token is set by the caller, it may be refreshed on 401
+    gitlab_merge_request = GitlabMergeRequest(gitlab_mr_webhook, None)
+    state = gitlab_mr_webhook.object_attributes.state
+    notifiers = [
+        SlackNotifier(mapping.slack_user.access_token, mapping.channel_id)
+        for mapping in get_channel_mappings(gl_mapping)
+    ]
+    return gitlab_merge_request, notifiers, SlackNotifier.get_required_resources(state)
+
+
+def _log_fetch_plan(gitlab_merge_request: GitlabMergeRequest):
+    fetched = ", ".join(sorted(gitlab_merge_request.fetch_plan))
+    state = gitlab_merge_request.gl_mr_webhook.object_attributes.state
+    logger.info(f"Fetched {fetched} for {state.value} MR")
+
+
+def process_webhook(gl_mapping: GitlabRepoChMapping, payload: dict):
+    current_tenant.set(gl_mapping.slack_user.team_id)
+    gitlab_merge_request, notifiers, requires = _prepare_webhook(gl_mapping, payload)
+
+    def parse(access_token):
+        gitlab_merge_request.api_key = access_token
+        return gitlab_merge_request.parse(requires)
+
+    pull_request = with_access_token(gl_mapping.gitlab_oauth_token, parse)
+    _log_fetch_plan(gitlab_merge_request)
+    notify_channels(notifiers, pull_request)
+
+
+async def aprocess_webhook(gl_mapping: GitlabRepoChMapping, payload: dict):
+    current_tenant.set(gl_mapping.slack_user.team_id)
+    gitlab_merge_request, notifiers, requires = await sync_to_async(_prepare_webhook)(
+        gl_mapping, payload
+    )
+
+    async def aparse(access_token):
+        gitlab_merge_request.api_key = access_token
+        return await gitlab_merge_request.aparse(requires)
+
+    pull_request = await awith_access_token(gl_mapping.gitlab_oauth_token, aparse)
+    _log_fetch_plan(gitlab_merge_request)
+    await anotify_channels(notifiers, pull_request)
+
+
+def _is_superseded(job: WebhookJob):
+    return (
+        WebhookJob.objects.filter(
+            repository_id=job.repository_id, pr_id=job.pr_id, id__gt=job.id
+        )
+        .exclude(status=WebhookJob.Status.dead)
+        .exists()
+    )
+
+
+def _job_failed(job: WebhookJob, error: Exception):
+    job.last_error = repr(error)
+    job.locked_until = None
+    if _is_superseded(job):
+        # a retry would run after the newer event and render the older state
+        logger.info(f"Job {job.id} superseded by newer event of the MR")
+        job.status = WebhookJob.Status.done
+    elif isinstance(error, CircuitOpenError):
+        # the host is known to be down, wait for it without using up attempts
+        logger.warning(f"Job {job.id} put back to the queue: {error}")
+        job.attempts -= 1
+        job.status = WebhookJob.Status.pending
+        job.run_after = timezone.now() + timedelta(seconds=max(error.retry_in, 1))
+    elif job.attempts >= settings.JOB_MAX_ATTEMPTS:
+        logger.error(f"Job {job.id} failed on attempt {job.attempts}", exc_info=error)
+        logger.error(f"Job {job.id} moved to dead letter state")
+        job.status = WebhookJob.Status.dead
+    else:
+        logger.error(f"Job {job.id} failed on attempt {job.attempts}", exc_info=error)
+        backoff = settings.JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1)
+        job.status = WebhookJob.Status.pending
+        job.run_after = timezone.now() + timedelta(seconds=backoff)
+    job.save(
+        update_fields=[
+            "status",
+            "attempts",
+            "run_after",
+            "locked_until",
+            "last_error",
+            "updated_at",
+        ]
+    )
+
+
+def _job_done(job: WebhookJob):
+    job.status = WebhookJob.Status.done
+    job.locked_until = None
+    job.save(update_fields=["status", "locked_until", "updated_at"])
+
+
+def run_job(job: WebhookJob):
+    try:
+        process_webhook(job.gl_mapping, json.loads(job.payload))
+    except Exception as e:
+        _job_failed(job, e)
+        return False
+    _job_done(job)
+    return True
+
+
+async def arun_job(job: WebhookJob):
+    try:
+        await aprocess_webhook(job.gl_mapping, json.loads(job.payload))
+    except Exception as e:
+        await sync_to_async(_job_failed)(job, e)
+        return False
+    await sync_to_async(_job_done)(job)
+    return True
+
+
+def _collect_job_counts():
+    counts = WebhookJob.objects.values_list("status").annotate(Count("id"))
+    for status, count in counts:
+        yield {"status": status}, count
+
+
+registry.gauge(
+    "gemrabot_webhook_jobs",
+    "Webhook jobs in the queue per status",
+    ["status"],
+    collect=_collect_job_counts,
+)
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.executor import AsyncPartitionedExecutor, PartitionedExecutor
+from api.http import get_async_client
+from api.jobs import arun_job, claim_next_job, run_job
+from api.metrics import registry
+from api.warmup import awarm_up_connections, warm_up
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        close_old_connections()
+        body = registry.expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Processes queued GitLab webhooks"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.JOB_QUEUE_WORKERS,
+            help="Number of lanes processing jobs concurrently, jobs of one merge "
+            "request are processed in order on the same lane",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.JOB_POLL_INTERVAL,
+            help="Seconds to wait when the queue is empty",
+        )
+        parser.add_argument(
+            "--async",
+            dest="use_async",
+            action="store_true",
+            help="Process jobs as asyncio tasks, lanes are then tasks",
+        )
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="Exit once the queue is drained instead of polling forever",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            help="Serve metrics of the worker process on given port",
+        )
+
+    def handle(self, *args, **options):
+        workers = options["workers"]
+        # jobs claimed ahead of the lanes, they wait there while holding a lease
+        self.max_queued = workers * 2
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        if settings.WARMUP:
+            warm_up()
+        if options["metrics_port"]:
+            server = ThreadingHTTPServer(("", options["metrics_port"]), MetricsHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        if options["use_async"]:
+            logger.info(f"Starting async webhook worker with {workers} lanes")
+            asyncio.run(
+                self.adispatch(workers, options["poll_interval"], options["burst"])
+            )
+            return
+        logger.info(f"Starting webhook worker with {workers} lanes")
+        executor = PartitionedExecutor(workers)
+        try:
+            self.dispatch(executor, options["poll_interval"], options["burst"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            executor.shutdown()
+
+    def dispatch(self, executor, poll_interval, burst):
+        """
+        Claims jobs and queues them on lanes by merge request, so events of
+        one merge request are processed in order they were claimed
+        """
+        slots = threading.Semaphore(self.max_queued)
+        while True:
+            slots.acquire()
+            close_old_connections()
+            job = claim_next_job(self.worker_id)
+            if job is None:
+                slots.release()
+                if burst:
+                    break
+                time.sleep(poll_interval)
+                continue
+            executor.submit((job.repository_id, job.pr_id), self.run, job, slots)
+        close_old_connections()
+
+    def run(self, job, slots):
+        try:
+            close_old_connections()
+            run_job(job)
+        finally:
+            slots.release()
+
+    async def adispatch(self, workers, poll_interval, burst):
+        if settings.WARMUP:
+            await awarm_up_connections()
+        executor = AsyncPartitionedExecutor(workers)
+        slots = asyncio.Semaphore(self.max_queued)
+        while True:
+            await slots.acquire()
+            job = await sync_to_async(claim_next_job)(self.worker_id)
+            if job is None:
+                slots.release()
+                if burst:
+                    break
+                await sync_to_async(close_old_connections)()
+                await asyncio.sleep(poll_interval)
+                continue
+            executor.submit((job.repository_id, job.pr_id), self.arun, job, slots)
+        await executor.shutdown()
+        await get_async_client().aclose()
+
+    async def arun(self, job, slots):
+        try:
+            await arun_job(job)
+        finally:
+            slots.release()
@@ -0,0 +1,225 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter_ns
+
+# workspace (slack team id) on whose behalf outbound calls are made
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default="")
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    """
+    Counters and gauges are either updated directly or read from `collect`
+    callback at exposition, callback returns iterable of (labels dict, value)
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        if self.collect is not None:
+            series = [(self._key(labels), value) for labels, value in self.collect()]
+        else:
+            with self._lock:
+                series = list(self._series.items())
+        for key, value in series:
+            yield self.name, _format_labels(self.labels, key), value
+
+    def expose(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def observe_ns(self, nanoseconds, **labels):
+        self.observe(nanoseconds / 1e9, **labels)
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.observe_ns(perf_counter_ns() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = [(key, (list(b), s, c)) for key, (b, s, c) in self._series.items()]
+        for key, (bucket_counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, [("le", bound)])
+                yield f"{self.name}_bucket", labels, cumulative
+            labels = _format_labels(self.labels, key, [("le", "+Inf")])
+            yield f"{self.name}_bucket", labels, count
+            yield f"{self.name}_sum", _format_labels(self.labels, key), total
+            yield f"{self.name}_count", _format_labels(self.labels, key), count
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labels=(), collect=None):
+        return self._register(Counter, name, documentation, labels, collect)
+
+    def gauge(self, name, documentation, labels=(), collect=None):
+        return self._register(Gauge, name, documentation, labels, collect)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labels, buckets)
+
+    def expose(self):
+        """
+        Returns all metrics in prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.expose() for metric in metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.histogram(
+    "gemrabot_stage_seconds", "Time spent in pipeline stage", ["stage"]
+)
+gitlab_fetch_seconds = registry.histogram(
+    "gemrabot_gitlab_fetch_seconds", "Time of single GitLab fetch", ["resource"]
+)
+slack_call_seconds = registry.histogram(
+    "gemrabot_slack_call_seconds", "Time of Slack Web API call", ["method"]
+)
+db_query_seconds = registry.histogram(
+    "gemrabot_db_query_seconds", "Time of database query", ["alias"]
+)
+slack_updates_skipped = registry.counter(
+    "gemrabot_slack_updates_skipped_total",
+    "chat.update calls skipped because rendered blocks didn't change",
+)
+outbound_requests = registry.counter(
+    "gemrabot_outbound_requests_total",
+    "Outbound HTTP requests per remote host and tenant",
+    ["host", "tenant", "status"],
+)
+
+
+class DBQueryTimer:
+    """
+    Execute wrapper installed on every database connection
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter_ns()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            db_query_seconds.observe_ns(perf_counter_ns() - start, alias=self.alias)
+
+
+def install_db_timer(sender, connection, **kwargs):
+    if not any(isinstance(w, DBQueryTimer) for w in connection.execute_wrappers):
+        # first in the list, execute_wrapper() context managers pop from the end
+        connection.execute_wrappers.insert(0, DBQueryTimer(connection.alias))
+
+
+def count_outbound_request(host, status):
+    outbound_requests.inc(host=host, tenant=current_tenant.get(), status=status)
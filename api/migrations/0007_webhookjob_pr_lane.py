@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0006_webhookjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="webhookjob",
+            name="pr_id",
+            field=models.IntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name="webhookjob",
+            name="repository_id",
+            field=models.IntegerField(default=None, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="webhookjob",
+            index=models.Index(
+                fields=["repository_id", "pr_id", "status"],
+                name="api_webhook_reposit_b48e14_idx",
+            ),
+        ),
+    ]
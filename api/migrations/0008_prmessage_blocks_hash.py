@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0007_webhookjob_pr_lane"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="prmessage",
+            name="blocks_hash",
+            field=models.CharField(default=None, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:01
+
+from django.db import migrations
+
+
+def remove_duplicates(apps, schema_editor):
+    """
+    Keeps the newest message per channel and the newest token per user
+    (preferring authorized ones), mappings are moved to the kept token
+    """
+    PrMessage = apps.get_model("api", "PrMessage")
+    UserGitlabOAuthToken = apps.get_model("api", "UserGitlabOAuthToken")
+    GitlabRepoChMapping = apps.get_model("api", "GitlabRepoChMapping")
+
+    kept = {}
+    for pr_message in PrMessage.objects.order_by("-id"):
+        key = (pr_message.repository_id, pr_message.pr_id, pr_message.message_channel)
+        if key in kept:
+            pr_message.delete()
+        else:
+            kept[key] = pr_message
+
+    kept = {}
+    tokens = sorted(
+        UserGitlabOAuthToken.objects.all(),
+        key=lambda token: (token.gitlab_access_token is None, -token.id),
+    )
+    for token in tokens:
+        key = (token.slack_user_id, token.slack_team_id, token.slack_owner_user_id)
+        if key in kept:
+            GitlabRepoChMapping.objects.filter(gitlab_oauth_token=token).update(
+                gitlab_oauth_token=kept[key]
+            )
+            token.delete()
+        else:
+            kept[key] = token
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0008_prmessage_blocks_hash"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:01
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0009_remove_duplicate_rows"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="prmessage",
+            name="claimed_at",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name="usergitlaboauthtoken",
+            name="state_hash",
+            field=models.UUIDField(default=uuid.uuid4, unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name="prmessage",
+            constraint=models.UniqueConstraint(
+                fields=("repository_id", "pr_id", "message_channel"),
+                name="unique_pr_message_per_channel",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="usergitlaboauthtoken",
+            constraint=models.UniqueConstraint(
+                fields=("slack_user_id", "slack_team_id", "slack_owner_user"),
+                name="unique_gitlab_oauth_token_per_user",
+            ),
+        ),
+    ]
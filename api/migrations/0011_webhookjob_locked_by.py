@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0010_unique_lookups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="webhookjob",
+            name="locked_by",
+            field=models.CharField(blank=True, default="", max_length=128),
+        ),
+    ]
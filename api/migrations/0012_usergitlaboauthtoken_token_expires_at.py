@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0011_webhookjob_locked_by"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="usergitlaboauthtoken",
+            name="gitlab_token_expires_at",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from uuid import uuid4
 
 from django.db import models
+from django.utils import timezone
 
 
 class SlackUser(models.Model):
@@ -15,14 +16,23 @@ class SlackUser(models.Model):
 class UserGitlabOAuthToken(models.Model):
     gitlab_user_id = models.IntegerField(default=None, null=True)
     gitlab_user_name = models.CharField(max_length=255, default=None, null=True)
-    state_hash = models.UUIDField(default=uuid4)
+    state_hash = models.UUIDField(default=uuid4, unique=True)
     gitlab_access_token = models.CharField(max_length=255, default=None, null=True)
     gitlab_refresh_token = models.CharField(max_length=255, default=None, null=True)
+    gitlab_token_expires_at = models.DateTimeField(default=None, null=True)
 
     slack_owner_user = models.ForeignKey(SlackUser, on_delete=models.CASCADE)
     slack_user_id = models.CharField(max_length=255)
     slack_team_id = models.CharField(max_length=255)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["slack_user_id", "slack_team_id", "slack_owner_user"],
+                name="unique_gitlab_oauth_token_per_user",
+            )
+        ]
+
 
 class GitlabRepoChMapping(models.Model):
     channel_id = models.CharField(max_length=255, db_index=True)
@@ -48,3 +58,45 @@ class PrMessage(models.Model):
     message_ts = models.CharField(max_length=255)
     pr_id = models.IntegerField()
     repository_id = models.IntegerField()
+    # sha256 of the posted blocks, updates with the same blocks are skipped
+    blocks_hash = models.CharField(max_length=64, default=None, null=True)
+    # rows without message_ts are claims of a worker that is posting the message
+    claimed_at = models.DateTimeField(default=None, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["repository_id", "pr_id", "message_channel"],
+                name="unique_pr_message_per_channel",
+            )
+        ]
+
+    @property
+    def is_posted(self):
+        return bool(self.message_ts)
+
+
+class WebhookJob(models.Model):
+    class Status(models.TextChoices):
+        pending = "pending"
+        running = "running"
+        done = "done"
+        dead = "dead"
+
+    gl_mapping = models.ForeignKey(GitlabRepoChMapping, on_delete=models.CASCADE)
+    repository_id = models.IntegerField(default=None, null=True)
+    pr_id = models.IntegerField(default=None, null=True)
+    payload = models.TextField()
+    status = models.CharField(
+        max_length=16, choices=Status.choices, default=Status.pending, db_index=True
+    )
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now, db_index=True)
+    locked_until = models.DateTimeField(default=None, null=True)
+    locked_by = models.CharField(max_length=128, default="", blank=True)
+    last_error = models.TextField(default=None, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["repository_id", "pr_id", "status"])]
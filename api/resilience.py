@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from enum import Enum
+from time import monotonic
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+
+from api.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# errors after which the request may not have reached the host at all
+TRANSPORT_ERRORS = (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+http_retries = registry.counter(
+    "gemrabot_http_retries_total", "Retried outbound HTTP requests", ["host"]
+)
+circuit_rejected = registry.counter(
+    "gemrabot_circuit_rejected_total",
+    "Outbound HTTP requests rejected by open circuit breaker",
+    ["host"],
+)
+
+
+class CircuitState(str, Enum):
+    closed = "closed"
+    half_open = "half_open"
+    open = "open"
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, host, retry_in):
+        super().__init__(f"Circuit of {host} is open, retry in {retry_in:.1f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures of a host and rejects
+    calls for `reset_timeout` seconds. Then a single trial call is let
+    through, its outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, host, failure_threshold, reset_timeout):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.closed
+        self.failures = 0
+        self.opened_at = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == CircuitState.closed:
+                return
+            retry_in = self.opened_at + self.reset_timeout - monotonic()
+            if self.state == CircuitState.open and retry_in <= 0:
+                self.state = CircuitState.half_open
+            if self.state == CircuitState.half_open and not self._trial_running:
+                self._trial_running = True
+                return
+        circuit_rejected.inc(host=self.host)
+        raise CircuitOpenError(self.host, max(retry_in, 0))
+
+    def release(self):
+        """
+        Call was interrupted without telling anything about the host
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CircuitState.closed:
+                logger.info(f"Circuit of {self.host} closed")
+            self.state = CircuitState.closed
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if (
+                self.state == CircuitState.half_open
+                or self.failures >= self.failure_threshold
+            ):
+                if self.state != CircuitState.open:
+                    logger.warning(f"Circuit of {self.host} opened")
+                self.state = CircuitState.open
+                self.opened_at = monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(url) -> CircuitBreaker:
+    host = urlsplit(url).netloc
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(
+                host,
+                settings.CIRCUIT_BREAKER_FAILURES,
+                settings.CIRCUIT_BREAKER_RESET_TIMEOUT,
+            )
+        return breaker
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, meant only for idempotent requests
+    """
+
+    def __init__(self, retries, backoff, max_backoff):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+
+NO_RETRY = RetryPolicy(0, 0, 0)
+
+
+def _is_failure(response):
+    return response.status_code >= 500
+
+
+def call(url, send, policy=NO_RETRY):
+    """
+    Sends request with `send` through the circuit breaker of url's host,
+    retrying transport errors and retryable statuses according to `policy`
+    """
+    breaker = get_breaker(url)
+    for attempt in range(policy.retries + 1):
+        if attempt:
+            http_retries.inc(host=breaker.host)
+            time.sleep(policy.delay(attempt - 1))
+        breaker.before_call()
+        try:
+            response = send()
+        except TRANSPORT_ERRORS:
+            breaker.record_failure()
+            if attempt == policy.retries:
+                raise
+            continue
+        except BaseException:
+            breaker.release()
+            raise
+        if _is_failure(response):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if response.status_code not in RETRY_STATUSES:
+            break
+    return response
+
+
+async def acall(url, send, policy=NO_RETRY):
+    breaker = get_breaker(url)
+    for attempt in range(policy.retries + 1):
+        if attempt:
+            http_retries.inc(host=breaker.host)
+            await asyncio.sleep(policy.delay(attempt - 1))
+        breaker.before_call()
+        try:
+            response = await send()
+        except TRANSPORT_ERRORS:
+            breaker.record_failure()
+            if attempt == policy.retries:
+                raise
+            continue
+        except BaseException:
+            breaker.release()
+            raise
+        if _is_failure(response):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if response.status_code not in RETRY_STATUSES:
+            break
+    return response
+
+
+def _collect_breaker_states():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    for breaker in breakers:
+        for state in CircuitState:
+            yield {"host": breaker.host, "state": state.value}, int(
+                breaker.state == state
+            )
+
+
+registry.gauge(
+    "gemrabot_circuit_breaker_state",
+    "State of circuit breaker per remote host, 1 for the current state",
+    ["host", "state"],
+    collect=_collect_breaker_states,
+)
@@ -0,0 +1,91 @@
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from time import monotonic
+from typing import Any, Hashable, Optional
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from api.metrics import registry
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    etag: Optional[str]
+    expires_at: float
+
+    def is_fresh(self):
+        return monotonic() < self.expires_at
+
+
+class ResponseCache(ABC):
+    """
+    Interface for caches used under GitlabMergeRequest._get, any backend
+    configured in GITLAB_CACHE_BACKEND has to implement get/set.
+    """
+
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"hits": 0, "misses": 0, "revalidated": 0})
+
+    @abstractmethod
+    def get(self, key: Hashable) -> Optional[CacheEntry]:
+        pass
+
+    @abstractmethod
+    def set(self, key: Hashable, entry: CacheEntry):
+        pass
+
+    def record(self, endpoint: str, outcome: str):
+        with self._stats_lock:
+            self._stats[endpoint][outcome] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {endpoint: dict(counts) for endpoint, counts in self._stats.items()}
+
+
+class LRUResponseCache(ResponseCache):
+    def __init__(self, max_entries=1024):
+        super().__init__()
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+@lru_cache(maxsize=None)
+def get_response_cache() -> ResponseCache:
+    backend = import_string(settings.GITLAB_CACHE_BACKEND)
+    return backend(**settings.GITLAB_CACHE_OPTIONS)
+
+
+def _collect_cache_stats():
+    for endpoint, counts in get_response_cache().stats().items():
+        for outcome, count in counts.items():
+            yield {"endpoint": endpoint, "outcome": outcome}, count
+
+
+registry.counter(
+    "gemrabot_gitlab_cache_lookups_total",
+    "GitLab response cache lookups per endpoint and outcome",
+    ["endpoint", "outcome"],
+    collect=_collect_cache_stats,
+)
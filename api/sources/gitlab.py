@@ -1,25 +1,114 @@
+import asyncio
 import logging
+from contextvars import copy_context
 from concurrent.futures.thread import ThreadPoolExecutor
-from typing import List
+from time import monotonic
+from typing import TYPE_CHECKING, FrozenSet, List
 
-import requests
-from dateutil.parser import parse
 from django.conf import settings
 from rest_framework import exceptions
-from unidiff import PatchSet, PatchedFile
 
 from api.data_models import (
     PullRequest,
     PullRequestStatus,
     FileAction,
     PullRequestFile,
-    PatchedFileRepr,
-    GitlabMRWebhook,
+    DiffStat,
+    GitlabMRWebhookView,
+    FetchResource,
 )
+from api.http import get_async_client, get_session
+from api.metrics import gitlab_fetch_seconds
+from api.resilience import RetryPolicy, acall, call
+from api.sources.cache import CacheEntry, get_response_cache
 from api.utils import measure
 
+if TYPE_CHECKING:
+    from gitlab import Gitlab
+
 logger = logging.getLogger(__name__)
 
+GET_RETRY_POLICY = RetryPolicy(
+    settings.GITLAB_GET_RETRIES,
+    settings.HTTP_RETRY_BACKOFF,
+    settings.HTTP_RETRY_MAX_BACKOFF,
+)
+
+# resources needed to describe MR in given state, regardless of how it's rendered
+STATE_RESOURCES = {
+    PullRequestStatus.opened: set(),
+    PullRequestStatus.closed: {FetchResource.merge_request},
+    PullRequestStatus.merged: {FetchResource.merge_request},
+}
+
+
+def get_gitlab_api(**kwargs) -> "Gitlab":
+    # python-gitlab is used only by oauth & interactions, imported on first use
+    from gitlab import Gitlab
+
+    return Gitlab(
+        settings.GITLAB_HOST, session=get_session(settings.GITLAB_HOST), **kwargs
+    )
+
+
+def approve_merge_request(access_token, project_id, iid):
+    """
+    Approves MR with a single call, the response tells how it went
+    """
+    url = (
+        f"{settings.GITLAB_HOST}/api/v4/projects/{project_id}"
+        f"/merge_requests/{iid}/approve"
+    )
+    return call(
+        url,
+        lambda: get_session(url).post(
+            url,
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=settings.HTTP_TIMEOUT,
+        ),
+    )
+
+
+def list_open_merge_requests(access_token, project_id, limit):
+    """
+    Returns up to `limit` open MRs of the project that aren't drafts, recently
+    updated first
+    """
+    url = (
+        f"{settings.GITLAB_HOST}/api/v4/projects/{project_id}/merge_requests"
+        f"?state=opened&wip=no&order_by=updated_at&per_page={limit}"
+    )
+    response = call(
+        url,
+        lambda: get_session(url).get(
+            url,
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=settings.HTTP_TIMEOUT,
+        ),
+        GET_RETRY_POLICY,
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def get_current_user(access_token):
+    """
+    Returns the user the token belongs to, raises HTTPError when gitlab
+    rejects the token
+    """
+    url = f"{settings.GITLAB_HOST}/api/v4/user"
+    response = call(
+        url,
+        lambda: get_session(url).get(
+            url,
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=settings.HTTP_TIMEOUT,
+        ),
+        GET_RETRY_POLICY,
+    )
+    response.raise_for_status()
+    return response.json()
+
 
 class GitlabOAuthClient:
     def __init__(self, host, client_id, client_secret):
@@ -44,7 +133,7 @@ class GitlabOAuthClient:
         )
 
     def revoke_auth(self, token):
-        response = requests.post(
+        response = get_session(self.host).post(
             f"{self.host}/oauth/revoke",
             {
                 "token": token,
@@ -56,7 +145,7 @@ class GitlabOAuthClient:
         return response.json()
 
     def complete_auth(self, code, redirect_uri):
-        response = requests.post(
+        response = get_session(self.host).post(
             f"{self.host}/oauth/token",
             {
                 "client_id": self.client_id,
@@ -69,9 +158,102 @@ class GitlabOAuthClient:
         response.raise_for_status()
         return response.json()
 
+    def refresh_auth(self, refresh_token):
+        response = get_session(self.host).post(
+            f"{self.host}/oauth/token",
+            {
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "refresh_token": refresh_token,
+                "grant_type": "refresh_token",
+            },
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+class DiffStatsCollector:
+    """
+    Counts added/removed lines per change entry as they come. Hunk text is kept
+    only while the whole MR fits into `inline_limit` lines, past that only
+    first `summary_files` files are kept for the summary. Pages of diffs are
+    read until `max_bytes` or `max_files` is reached, files of the rest are
+    only counted.
+    """
+
+    def __init__(self, inline_limit, summary_files, max_bytes=None, max_files=None):
+        self.inline_limit = inline_limit
+        self.summary_files = summary_files
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.files: List[PullRequestFile] = []
+        self.files_count = 0
+        self.lines_added = 0
+        self.lines_removed = 0
+        self.bytes_read = 0
+        self.inline = True
+
+    @staticmethod
+    def get_action(change) -> FileAction:
+        if change["new_file"]:
+            return FileAction.created
+        if change["deleted_file"]:
+            return FileAction.removed
+        if change["renamed_file"]:
+            return FileAction.renamed
+        return FileAction.changed
+
+    def add(self, change):
+        diff = change["diff"]
+        # gitlab diffs start at first hunk, so no ---/+++ headers to skip
+        added = diff.count("\n+") + diff.startswith("+")
+        removed = diff.count("\n-") + diff.startswith("-")
+        self.files_count += 1
+        self.lines_added += added
+        self.lines_removed += removed
+
+        if self.inline and self.lines_added + self.lines_removed > self.inline_limit:
+            self.to_summary()
+        if not self.inline and len(self.files) >= self.summary_files:
+            return
+
+        filename = change["old_path"] if change["deleted_file"] else change["new_path"]
+        self.files.append(
+            PullRequestFile(
+                filename=filename,
+                action=self.get_action(change),
+                diff=DiffStat(diff if self.inline else "", added, removed),
+            )
+        )
+
+    def to_summary(self):
+        self.inline = False
+        self.files = [
+            f.copy(update={"diff": DiffStat("", f.diff.added, f.diff.removed)})
+            for f in self.files[: self.summary_files]
+        ]
+
+    def add_page(self, changes, size):
+        self.bytes_read += size
+        for change in changes:
+            self.add(change)
+
+    def is_full(self):
+        if self.max_bytes is not None and self.bytes_read >= self.max_bytes:
+            return True
+        return self.max_files is not None and self.files_count >= self.max_files
+
+    def add_unread(self, count):
+        """
+        Counts files of pages that weren't fetched, MR is shown as summary
+        """
+        self.files_count += count
+        if self.inline:
+            self.to_summary()
+
 
 class GitlabMergeRequest:
-    def __init__(self, gl_mr_webhook: GitlabMRWebhook, api_key):
+    def __init__(self, gl_mr_webhook: GitlabMRWebhookView, api_key):
         self.gl_mr_webhook = gl_mr_webhook
         self.api_key = api_key
         self.user = None
@@ -79,91 +261,210 @@ class GitlabMergeRequest:
         self.merge_request = None
         self.approvals = None
         self.changes = None
+        self.fetch_plan = None
 
     def get_client(self):
-        session = requests.session()
-        session.headers.update({"Authorization": f"Bearer {self.api_key}"})
-        return session
+        return get_session(settings.GITLAB_HOST)
 
-    def _get(self, url, **kwargs):
-        client = self.get_client()
-        response = client.get(url, **kwargs)
-        response.raise_for_status()
-        return response.json()
+    def _auth_headers(self):
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def _get_cached(self, url, cache_as):
+        """
+        Returns cache entry (fresh or not) and headers for the request,
+        stale entries with ETag are revalidated with If-None-Match
+        """
+        headers = self._auth_headers()
+        if not settings.GITLAB_CACHE_TTLS.get(cache_as, 0):
+            return None, headers
+        entry = get_response_cache().get((self.api_key, url))
+        if entry is not None and entry.is_fresh():
+            get_response_cache().record(cache_as, "hits")
+        elif entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        return entry, headers
 
-    def set_user(self, user_id: int):
-        self.user = self._get(f"{settings.GITLAB_HOST}/api/v4/users/{user_id}")
+    def _read_response(self, url, cache_as, entry, response):
+        ttl = settings.GITLAB_CACHE_TTLS.get(cache_as, 0)
+        if not ttl:
+            response.raise_for_status()
+            return response.json()
 
-    def set_project(self, project_id: int):
-        self.project = self._get(f"{settings.GITLAB_HOST}/api/v4/projects/{project_id}")
+        cache = get_response_cache()
+        if entry is not None and response.status_code == 304:
+            cache.record(cache_as, "revalidated")
+            entry.expires_at = monotonic() + ttl
+            # backends may hand out copies, the new expiry has to be stored
+            cache.set((self.api_key, url), entry)
+            return entry.value
 
-    def set_merge_request(self, project_id, merge_request_id: int):
-        self.merge_request = self._get(
-            f"{settings.GITLAB_HOST}/api/v4/projects/{project_id}/merge_requests/{merge_request_id}"
+        response.raise_for_status()
+        cache.record(cache_as, "misses")
+        value = response.json()
+        cache.set(
+            (self.api_key, url),
+            CacheEntry(value, response.headers.get("ETag"), monotonic() + ttl),
         )
+        return value
 
-    def set_changes(self, project_id, merge_request_id):
-        self.changes = self._get(
-            f"{settings.GITLAB_HOST}/api/v4/projects/{project_id}/merge_requests/{merge_request_id}/changes"
+    def _get(self, url, cache_as=None):
+        entry, headers = self._get_cached(url, cache_as)
+        if entry is not None and entry.is_fresh():
+            return entry.value
+        response = call(
+            url,
+            lambda: self.get_client().get(
+                url, headers=headers, timeout=settings.HTTP_TIMEOUT
+            ),
+            GET_RETRY_POLICY,
         )
+        return self._read_response(url, cache_as, entry, response)
 
-    def set_approvals(self, project_id, merge_request_id):
-        self.approvals = self._get(
-            f"{settings.GITLAB_HOST}/api/v4/projects/{project_id}/merge_requests/{merge_request_id}/approvals"
+    async def _aget(self, url, cache_as=None):
+        entry, headers = self._get_cached(url, cache_as)
+        if entry is not None and entry.is_fresh():
+            return entry.value
+        response = await acall(
+            url, lambda: get_async_client().get(url, headers=headers), GET_RETRY_POLICY
         )
+        return self._read_response(url, cache_as, entry, response)
 
-    @measure
-    def fetch_all(self):
-        project_id = self.gl_mr_webhook.object_attributes.target_project_id
-        mr_id = self.gl_mr_webhook.object_attributes.iid
-        with ThreadPoolExecutor(max_workers=5) as e:
-            e.submit(self.set_user, self.gl_mr_webhook.object_attributes.author_id)
-            e.submit(self.set_project, project_id)
-            e.submit(self.set_merge_request, project_id, mr_id)
-            e.submit(self.set_changes, project_id, mr_id)
-            e.submit(self.set_approvals, project_id, mr_id)
-
-    def build_patch_set(self, changes):
-        all_changes = ""
-        for change in changes["changes"]:
-            changes_txt: str = change["diff"]
-            header = f"diff --git a/{change['old_path']} b/{change['new_path']}\n"
-            if change["new_file"]:
-                header += f"new file mode {change['b_mode']} \n"
-            header += f"index 0000000..0000000 100644\n"
-            if "Binary files" not in changes_txt:
-                header += f"--- a/{change['old_path']}\n"
-                header += f"+++ b/{change['new_path']}\n"
-            all_changes += header
-            all_changes += changes_txt
-
-        patch = PatchSet(all_changes)
-        return patch
-
-    def get_pull_request_files_from_patch_set(
-        self, patch_set: List[PatchedFile]
-    ) -> List[PullRequestFile]:
-        files_list = []
-        for file in patch_set:
-            if file.is_added_file:
-                action = FileAction.created
-            elif file.is_removed_file:
-                action = FileAction.removed
-            elif file.is_rename:
-                action = FileAction.renamed
-            else:
-                action = FileAction.changed
-            files_list.append(
-                PullRequestFile(
-                    filename=file.path, action=action, diff=PatchedFileRepr(file)
-                )
+    def get_resource_request(self, resource: FetchResource):
+        """
+        Returns url of given resource and name under which it's cached
+        """
+        attributes = self.gl_mr_webhook.object_attributes
+        api_url = f"{settings.GITLAB_HOST}/api/v4"
+        project_url = f"{api_url}/projects/{attributes.target_project_id}"
+        mr_url = f"{project_url}/merge_requests/{attributes.iid}"
+        return {
+            FetchResource.user: (f"{api_url}/users/{attributes.author_id}", "user"),
+            FetchResource.project: (project_url, "project"),
+            FetchResource.merge_request: (mr_url, None),
+            FetchResource.changes: (f"{mr_url}/diffs", None),
+            FetchResource.approvals: (f"{mr_url}/approvals", None),
+        }[resource]
+
+    def new_diff_collector(self) -> DiffStatsCollector:
+        return DiffStatsCollector(
+            settings.INLINE_DIFF_MAX_LINES,
+            settings.SUMMARY_MAX_FILES,
+            settings.GITLAB_DIFF_MAX_BYTES,
+            settings.GITLAB_DIFF_MAX_FILES,
+        )
+
+    def _diff_page_request(self, url, page):
+        page_url = f"{url}?page={page}&per_page={settings.GITLAB_DIFF_PAGE_SIZE}"
+        return page_url, {**self._auth_headers(), "Accept-Encoding": "gzip"}
+
+    def _read_diff_page(self, collector: DiffStatsCollector, response):
+        """
+        Adds page to the collector and returns number of the next page to
+        fetch, None when it was the last one or the collector is full
+        """
+        response.raise_for_status()
+        collector.add_page(response.json(), len(response.content))
+        next_page = response.headers.get("X-Next-Page")
+        if not next_page or not collector.is_full():
+            return next_page or None
+        # gitlab leaves out X-Total for really big collections
+        total = int(response.headers.get("X-Total") or collector.files_count)
+        collector.add_unread(max(total - collector.files_count, 0))
+        return None
+
+    def fetch_diffs(self, url) -> DiffStatsCollector:
+        """
+        Streams diffs of the MR page by page, so only one page is held in
+        memory no matter how big the MR is
+        """
+        collector = self.new_diff_collector()
+        page = 1
+        while page:
+            page_url, headers = self._diff_page_request(url, page)
+            response = call(
+                page_url,
+                lambda: self.get_client().get(
+                    page_url, headers=headers, timeout=settings.HTTP_TIMEOUT
+                ),
+                GET_RETRY_POLICY,
             )
-        return files_list
+            page = self._read_diff_page(collector, response)
+        return collector
+
+    async def afetch_diffs(self, url) -> DiffStatsCollector:
+        collector = self.new_diff_collector()
+        page = 1
+        while page:
+            page_url, headers = self._diff_page_request(url, page)
+            response = await acall(
+                page_url,
+                lambda: get_async_client().get(page_url, headers=headers),
+                GET_RETRY_POLICY,
+            )
+            page = self._read_diff_page(collector, response)
+        return collector
+
+    def fetch(self, resource: FetchResource):
+        url, cache_as = self.get_resource_request(resource)
+        with gitlab_fetch_seconds.time(resource=resource.value):
+            if resource == FetchResource.changes:
+                self.changes = self.fetch_diffs(url)
+            else:
+                setattr(self, resource.value, self._get(url, cache_as))
+
+    async def afetch(self, resource: FetchResource):
+        url, cache_as = self.get_resource_request(resource)
+        with gitlab_fetch_seconds.time(resource=resource.value):
+            if resource == FetchResource.changes:
+                self.changes = await self.afetch_diffs(url)
+            else:
+                setattr(self, resource.value, await self._aget(url, cache_as))
+
+    def build_fetch_plan(self, requires=None) -> FrozenSet[FetchResource]:
+        if requires is None:
+            return frozenset(FetchResource)
+        state = self.gl_mr_webhook.object_attributes.state
+        return frozenset({FetchResource.user, *STATE_RESOURCES[state], *requires})
 
     @measure
-    def parse(self) -> PullRequest:
-        self.fetch_all()
-        approval_names = [x["user"]["name"] for x in self.approvals["approved_by"]]
+    def fetch_all(self, fetch_plan=frozenset(FetchResource)):
+        resources = [r for r in FetchResource if r in fetch_plan]
+        with ThreadPoolExecutor(max_workers=len(FetchResource)) as e:
+            # context is copied so outbound calls are attributed to the tenant
+            futures = [
+                e.submit(copy_context().run, self.fetch, resource)
+                for resource in resources
+            ]
+        # surface fetch errors so the job gets retried
+        for future in futures:
+            future.result()
+
+    @measure
+    async def afetch_all(self, fetch_plan=frozenset(FetchResource)):
+        resources = [r for r in FetchResource if r in fetch_plan]
+        await asyncio.gather(*[self.afetch(resource) for resource in resources])
+
+    @measure
+    def parse(self, requires=None) -> PullRequest:
+        """
+        Fetches only resources that are needed for MR state and given
+        `requires` (resources used by the renderer), everything is fetched
+        when `requires` is not provided.
+        """
+        self.fetch_plan = self.build_fetch_plan(requires)
+        self.fetch_all(self.fetch_plan)
+        return self.build_pull_request()
+
+    @measure
+    async def aparse(self, requires=None) -> PullRequest:
+        self.fetch_plan = self.build_fetch_plan(requires)
+        await self.afetch_all(self.fetch_plan)
+        return self.build_pull_request()
+
+    def build_pull_request(self) -> PullRequest:
+        approval_names = []
+        if self.approvals is not None:
+            approval_names = [x["user"]["name"] for x in self.approvals["approved_by"]]
         closed_by = ""
         merged_by = ""
         time_to_merge = 0
@@ -171,13 +472,14 @@ class GitlabMergeRequest:
         if state == PullRequestStatus.closed:
             closed_by = self.merge_request["closed_by"]["name"]
         if state == PullRequestStatus.merged:
+            from dateutil.parser import parse
+
             merged_at = parse(self.merge_request["merged_at"])
             created_at = parse(self.merge_request["created_at"])
             diff = merged_at - created_at
             time_to_merge = diff.total_seconds()
             merged_by = self.merge_request["merged_by"]["name"]
-        patch_set = self.build_patch_set(self.changes)
-        pr_files = self.get_pull_request_files_from_patch_set(patch_set)
+        diff_stats = self.changes or DiffStatsCollector(0, 0)
         return PullRequest(
             gitlab_mr_webhook=self.gl_mr_webhook,
             closed_by=closed_by,
@@ -187,7 +489,11 @@ class GitlabMergeRequest:
             approvals=",".join(approval_names),
             approval_count=len(approval_names),
             time_to_merge=time_to_merge,
-            changes=pr_files,
+            changes=diff_stats.files,
+            files_count=diff_stats.files_count,
+            lines_added=diff_stats.lines_added,
+            lines_removed=diff_stats.lines_removed,
+            inline_diff=diff_stats.inline,
         )
 
 
@@ -200,8 +506,13 @@ def validate_gitlab_header_event(request):
         )
 
 
-def validate_gitlab_header_token(request, gl_mapping):
+def validate_gitlab_header_token(request, gl_mappings):
+    """
+    Returns the mapping whose webhook secret was sent with the request
+    """
     gitlab_header_token = request.META.get("HTTP_X_GITLAB_TOKEN")
-    if str(gl_mapping.webhook_secret) != gitlab_header_token:
-        logger.error(f"Tokens mismatch")
-        raise exceptions.ValidationError("Invalid x-gitlab-token, request malformed")
+    for gl_mapping in gl_mappings:
+        if str(gl_mapping.webhook_secret) == gitlab_header_token:
+            return gl_mapping
+    logger.error(f"Tokens mismatch")
+    raise exceptions.ValidationError("Invalid x-gitlab-token, request malformed")
@@ -0,0 +1,409 @@
+import threading
+from copy import deepcopy
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+import requests
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase
+from django.utils import timezone
+
+from api.destinations.interactions import (
+    approve_all_mr_action,
+    approve_mr_action,
+    view_submission_add_gl_project_to_ch_submit,
+)
+from api.data_models import PullRequest
+from api.destinations.slack import (
+    MessageClaimedError,
+    SlackNotifier,
+    _claim_pr_message,
+)
+from api.http import get_session
+from api.jobs import claimable_jobs, enqueue_webhook
+from api.models import (
+    GitlabRepoChMapping,
+    PrMessage,
+    SlackUser,
+    UserGitlabOAuthToken,
+    WebhookJob,
+)
+from api.sources.cache import CacheEntry, ResponseCache
+from api.sources.gitlab import GitlabMergeRequest, GitlabOAuthClient
+from api.tokens import get_access_token, with_access_token
+from api.utils import assert_max_queries
+from api.views import slack_command
+
+
+def gitlab_response(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return response
+
+
+def unauthorized():
+    return requests.HTTPError(response=gitlab_response(401))
+
+
+@mock.patch.object(GitlabOAuthClient, "refresh_auth")
+class TokenRefreshTest(TestCase):
+    def setUp(self):
+        slack_user = SlackUser.objects.create(
+            user_id="U1", bot_user_id="B1", team_id="T1", team_name="t"
+        )
+        self.token = UserGitlabOAuthToken.objects.create(
+            slack_owner_user=slack_user,
+            slack_user_id="U1",
+            slack_team_id="T1",
+            gitlab_access_token="old",
+            gitlab_refresh_token="refresh",
+            gitlab_token_expires_at=timezone.now() + timedelta(seconds=10),
+        )
+
+    def test_refresh_without_expires_in_makes_token_non_expiring(self, refresh_auth):
+        refresh_auth.return_value = {"access_token": "new", "refresh_token": "r2"}
+
+        tokens = [get_access_token(self.token) for _ in range(5)]
+
+        self.assertEqual(tokens, ["new"] * 5)
+        refresh_auth.assert_called_once_with("refresh")
+        self.token.refresh_from_db()
+        self.assertIsNone(self.token.gitlab_token_expires_at)
+        self.assertEqual(self.token.gitlab_refresh_token, "r2")
+
+    def test_non_expiring_token_is_refreshed_on_401(self, refresh_auth):
+        self.token.gitlab_token_expires_at = None
+        self.token.save()
+        refresh_auth.return_value = {"access_token": "new", "refresh_token": "r2"}
+        used_tokens = []
+
+        def call(access_token):
+            used_tokens.append(access_token)
+            if access_token == "old":
+                raise unauthorized()
+            return "ok"
+
+        self.assertEqual(with_access_token(self.token, call), "ok")
+        self.assertEqual(with_access_token(self.token, call), "ok")
+
+        self.assertEqual(used_tokens, ["old", "new", "new"])
+        refresh_auth.assert_called_once_with("refresh")
+
+
+class SetCookieHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.cookies.append(self.headers.get("Cookie"))
+        self.send_response(200)
+        self.send_header("Set-Cookie", "session=tenant-a; Path=/")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SharedSessionTest(SimpleTestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), SetCookieHandler)
+        self.server.cookies = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+
+    def test_shared_session_does_not_store_cookies(self):
+        get_session(self.url).get(self.url)
+        get_session(self.url).get(self.url)
+
+        self.assertEqual(len(get_session(self.url).cookies), 0)
+        self.assertEqual(self.server.cookies, [None, None])
+
+
+@mock.patch.object(SlackNotifier, "create_message", return_value={"ts": "2"})
+class DeliverTest(SimpleTestCase):
+    def setUp(self):
+        self.notifier = SlackNotifier("xoxb", "C1")
+        self.pr_message = PrMessage(message_channel="C1", message_ts="1")
+        self.message = {"blocks": []}
+
+    def deliver(self, update_error):
+        with mock.patch.object(
+            SlackNotifier, "update_message", side_effect=update_error
+        ):
+            return self.notifier.deliver(self.message, "hash", self.pr_message)
+
+    def test_deleted_message_is_posted_again(self, create_message):
+        error = requests.RequestException({"ok": False, "error": "message_not_found"})
+
+        self.assertIs(self.deliver(error), self.pr_message)
+        self.assertEqual(self.pr_message.message_ts, "2")
+
+    def test_other_slack_errors_skip_the_update(self, create_message):
+        error = requests.RequestException({"ok": False, "error": "channel_not_found"})
+
+        self.assertIsNone(self.deliver(error))
+        create_message.assert_not_called()
+
+    def test_connection_errors_are_raised(self, create_message):
+        error = requests.ConnectionError("Connection refused")
+
+        with self.assertRaises(requests.ConnectionError):
+            self.deliver(error)
+        create_message.assert_not_called()
+
+
+def create_workspace(team_id):
+    slack_user = SlackUser.objects.create(
+        user_id="U1", bot_user_id="B1", team_id=team_id, team_name=team_id
+    )
+    gl_oauth = UserGitlabOAuthToken.objects.create(
+        slack_owner_user=slack_user,
+        slack_user_id="U1",
+        slack_team_id=team_id,
+        gitlab_access_token=f"token-{team_id}",
+    )
+    return slack_user, gl_oauth
+
+
+def create_mapping(slack_user, gl_oauth, channel_id, **kwargs):
+    return GitlabRepoChMapping.objects.create(
+        slack_user=slack_user,
+        channel_id=channel_id,
+        repository_id=1,
+        repository_name="project",
+        gitlab_oauth_token=gl_oauth,
+        **kwargs,
+    )
+
+
+class EnqueueWebhookTest(TestCase):
+    payload = {"object_attributes": {"target_project_id": 1, "iid": 7}}
+
+    def setUp(self):
+        self.slack_user, self.gl_oauth = create_workspace("T1")
+
+    def test_events_of_one_hook_are_coalesced(self):
+        mapping = create_mapping(self.slack_user, self.gl_oauth, "C1")
+        create_mapping(
+            self.slack_user, self.gl_oauth, "C2", webhook_secret=mapping.webhook_secret
+        )
+
+        enqueue_webhook(mapping, self.payload)
+        enqueue_webhook(mapping, self.payload)
+
+        self.assertEqual(WebhookJob.objects.count(), 1)
+
+    def test_hooks_of_each_channel_keep_their_jobs(self):
+        first = create_mapping(self.slack_user, self.gl_oauth, "C1")
+        second = create_mapping(self.slack_user, self.gl_oauth, "C2")
+
+        enqueue_webhook(first, self.payload)
+        enqueue_webhook(second, self.payload)
+
+        self.assertCountEqual(
+            WebhookJob.objects.values_list("gl_mapping", flat=True),
+            [first.pk, second.pk],
+        )
+
+
+@mock.patch("api.destinations.interactions.update_view")
+@mock.patch("api.destinations.interactions.get_gitlab_api")
+class AddProjectTest(TestCase):
+    def submit(self, slack_user, channel_id):
+        payload = {
+            "user": {"id": "U1"},
+            "team": {"id": slack_user.team_id},
+            "view": {
+                "id": "V1",
+                "state": {
+                    "values": {
+                        "channel": {
+                            "add_gitlab_channel_id": {"selected_channel": channel_id}
+                        },
+                        "project": {"add_gitlab_project_id": {"value": "1"}},
+                    }
+                },
+            },
+        }
+        view_submission_add_gl_project_to_ch_submit(
+            slack_user, payload, "https://gemrabot.example.com/webhook/"
+        )
+        return GitlabRepoChMapping.objects.get(channel_id=channel_id)
+
+    def test_hook_is_shared_within_workspace_only(self, get_gitlab_api, update_view):
+        gl_project = get_gitlab_api.return_value.projects.get.return_value
+        gl_project.id = 1
+        gl_project.name = "project"
+        gl_project.hooks.create.side_effect = [mock.Mock(id=10), mock.Mock(id=20)]
+        slack_user, _ = create_workspace("T1")
+        other_slack_user, _ = create_workspace("T2")
+
+        first = self.submit(slack_user, "C1")
+        second = self.submit(slack_user, "C2")
+        other = self.submit(other_slack_user, "C3")
+
+        self.assertEqual(second.webhook_secret, first.webhook_secret)
+        self.assertEqual(second.webhook_id, 10)
+        self.assertNotEqual(other.webhook_secret, first.webhook_secret)
+        self.assertEqual(other.webhook_id, 20)
+
+
+@mock.patch.object(GitlabOAuthClient, "refresh_auth")
+@mock.patch("api.destinations.interactions.get_current_user")
+@mock.patch("api.destinations.interactions.get_session")
+@mock.patch("api.destinations.interactions.approve_merge_request")
+class ApproveTest(TestCase):
+    def setUp(self):
+        _, self.gl_oauth = create_workspace("T1")
+        self.gl_oauth.gitlab_refresh_token = "refresh"
+        self.gl_oauth.save()
+
+    def test_second_approve_reports_already_approved(
+        self, approve_merge_request, get_session, get_current_user, refresh_auth
+    ):
+        approve_merge_request.return_value = gitlab_response(401)
+
+        approve_mr_action("approve", "1", "7", self.gl_oauth, "https://slack/r")
+
+        refresh_auth.assert_not_called()
+        approve_merge_request.assert_called_once_with("token-T1", "1", "7")
+        message = get_session.return_value.post.call_args.kwargs["json"]
+        self.assertIn("already approved", message["text"])
+
+    def test_approved_mr_sends_no_message(
+        self, approve_merge_request, get_session, get_current_user, refresh_auth
+    ):
+        approve_merge_request.return_value = gitlab_response(201)
+
+        approve_mr_action("approve", "1", "7", self.gl_oauth, "https://slack/r")
+
+        get_session.return_value.post.assert_not_called()
+
+    def test_bulk_approve_refreshes_rejected_token_once(
+        self, approve_merge_request, get_session, get_current_user, refresh_auth
+    ):
+        get_current_user.side_effect = [unauthorized(), {"id": 1}]
+        refresh_auth.return_value = {"access_token": "new", "refresh_token": "r2"}
+        approve_merge_request.side_effect = [gitlab_response(201), gitlab_response(401)]
+
+        approve_all_mr_action("1-7,1-8", self.gl_oauth, "https://slack/r")
+
+        refresh_auth.assert_called_once_with("refresh")
+        self.assertEqual(
+            [call.args[0] for call in approve_merge_request.call_args_list],
+            ["new", "new"],
+        )
+        message = get_session.return_value.post.call_args.kwargs["json"]
+        self.assertEqual(message["text"], "Approved 1 of 2 merge requests")
+
+
+class SlackCommandQueriesTest(TestCase):
+    def run_command(self, team_id, mappings_count):
+        slack_user, gl_oauth = create_workspace(team_id)
+        for i in range(mappings_count):
+            create_mapping(slack_user, gl_oauth, f"C{i}")
+        client = Client()
+        # the first call of a user creates their token row
+        client.post("/slack/command/", {"team_id": team_id, "user_id": "U2"})
+        with assert_max_queries(slack_command.query_budget) as queries:
+            response = client.post(
+                "/slack/command/", {"team_id": team_id, "user_id": "U2"}
+            )
+        self.assertEqual(response.status_code, 200)
+        return queries.count
+
+    def test_query_count_does_not_grow_with_mappings(self):
+        self.assertEqual(self.run_command("T1", 2), self.run_command("T2", 40))
+
+
+class QueryPlanTest(TestCase):
+    """
+    Hot lookups have to be served by an index
+    """
+
+    def setUp(self):
+        if connection.vendor == "postgresql":
+            # tables are empty, make the planner show whether an index can be used
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+
+    @staticmethod
+    def is_full_scan(plan):
+        # sqlite reports "SCAN table" without an index, postgres "Seq Scan"
+        for line in plan.splitlines():
+            if "Seq Scan" in line:
+                return True
+            if "SCAN " in line and "USING" not in line:
+                return True
+        return False
+
+    def test_lookups_use_indexes(self):
+        lookups = {
+            "pr message per channel": PrMessage.objects.filter(
+                repository_id=1, pr_id=1, message_channel__in=["C1", "C2"]
+            ),
+            "gitlab token of slack user": UserGitlabOAuthToken.objects.filter(
+                slack_user_id="U1", slack_team_id="T1", slack_owner_user=1
+            ),
+            "gitlab token by oauth state": UserGitlabOAuthToken.objects.filter(
+                state_hash="00000000-0000-0000-0000-000000000000"
+            ),
+            "mappings of repository": GitlabRepoChMapping.objects.filter(
+                repository_id=1
+            ),
+            "slack workspace": SlackUser.objects.filter(team_id="T1"),
+            "pending job of merge request": WebhookJob.objects.filter(
+                repository_id=1, pr_id=1, status=WebhookJob.Status.pending
+            ),
+            "claimable jobs": claimable_jobs(timezone.now(), "worker"),
+        }
+        for name, queryset in lookups.items():
+            with self.subTest(name):
+                plan = queryset.explain()
+                self.assertFalse(self.is_full_scan(plan), plan)
+
+
+class ClaimPrMessageTest(TestCase):
+    def test_second_claim_of_channel_fails(self):
+        pull_request = mock.Mock(spec=PullRequest, id=7, repository_id=1)
+
+        claim = _claim_pr_message(pull_request, "C1")
+        second_claim = _claim_pr_message(pull_request, "C1")
+
+        self.assertIsInstance(claim, PrMessage)
+        self.assertIsInstance(second_claim, MessageClaimedError)
+        self.assertEqual(PrMessage.objects.count(), 1)
+        self.assertIsInstance(_claim_pr_message(pull_request, "C2"), PrMessage)
+
+
+class CopyingResponseCache(ResponseCache):
+    """
+    Backend that stores copies of entries, like caches outside the process
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.entries = {}
+
+    def get(self, key):
+        return deepcopy(self.entries.get(key))
+
+    def set(self, key, entry):
+        self.entries[key] = deepcopy(entry)
+
+
+class ResponseCacheTest(SimpleTestCase):
+    def test_revalidated_entry_is_stored_with_new_expiry(self):
+        cache = CopyingResponseCache()
+        key = ("token", "https://gitlab.example.com/api/v4/users/1")
+        cache.set(key, CacheEntry({"name": "Author"}, '"etag"', 0))
+        merge_request = mock.Mock(api_key="token")
+
+        with mock.patch("api.sources.gitlab.get_response_cache", return_value=cache):
+            value = GitlabMergeRequest._read_response(
+                merge_request, key[1], "user", cache.get(key), gitlab_response(304)
+            )
+
+        self.assertEqual(value, {"name": "Author"})
+        self.assertTrue(cache.get(key).is_fresh())
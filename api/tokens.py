@@ -0,0 +1,148 @@
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from api.metrics import registry
+from api.models import UserGitlabOAuthToken
+from api.sources.gitlab import GitlabOAuthClient
+
+logger = logging.getLogger(__name__)
+
+token_refreshes = registry.counter(
+    "gemrabot_gitlab_token_refreshes_total",
+    "GitLab OAuth token refreshes",
+    ["outcome"],
+)
+
+TOKEN_FIELDS = [
+    "gitlab_access_token",
+    "gitlab_refresh_token",
+    "gitlab_token_expires_at",
+]
+
+
+def apply_token_response(gl_oauth_token: UserGitlabOAuthToken, response: dict):
+    """
+    Stores tokens from response of GitLab /oauth/token endpoint
+    """
+    gl_oauth_token.gitlab_access_token = response["access_token"]
+    gl_oauth_token.gitlab_refresh_token = response.get("refresh_token")
+    expires_in = response.get("expires_in")
+    gl_oauth_token.gitlab_token_expires_at = (
+        timezone.now() + timedelta(seconds=expires_in) if expires_in else None
+    )
+
+
+class TokenManager:
+    """
+    Hands out access tokens of GitLab OAuth authorizations and refreshes them
+    `margin` seconds before they expire. Refresh of a token runs once, other
+    threads asking for it wait for the refresh and processes are serialized
+    by a row lock, GitLab rotates the refresh token on every use.
+    """
+
+    def __init__(self, margin):
+        self.margin = timedelta(seconds=margin)
+        self._locks = defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+
+    def needs_refresh(self, gl_oauth_token: UserGitlabOAuthToken):
+        # tokens without known expiry are refreshed only once gitlab rejects them
+        if (
+            not gl_oauth_token.gitlab_refresh_token
+            or gl_oauth_token.gitlab_token_expires_at is None
+        ):
+            return False
+        return gl_oauth_token.gitlab_token_expires_at - self.margin <= timezone.now()
+
+    def _lock(self, gl_oauth_token: UserGitlabOAuthToken):
+        with self._locks_lock:
+            return self._locks[gl_oauth_token.pk]
+
+    def get_access_token(self, gl_oauth_token: UserGitlabOAuthToken) -> str:
+        if self.needs_refresh(gl_oauth_token):
+            with self._lock(gl_oauth_token):
+                self._refresh(gl_oauth_token, self.needs_refresh)
+        return gl_oauth_token.gitlab_access_token
+
+    def refresh_rejected(
+        self, gl_oauth_token: UserGitlabOAuthToken, rejected_token
+    ) -> str:
+        """
+        Refreshes token gitlab answered 401 to, unless someone else already did
+        """
+        with self._lock(gl_oauth_token):
+            self._refresh(
+                gl_oauth_token,
+                lambda current: current.gitlab_refresh_token
+                and current.gitlab_access_token == rejected_token,
+            )
+        return gl_oauth_token.gitlab_access_token
+
+    def _refresh(self, gl_oauth_token: UserGitlabOAuthToken, needs_refresh):
+        with transaction.atomic():
+            current = UserGitlabOAuthToken.objects.select_for_update().get(
+                pk=gl_oauth_token.pk
+            )
+            if needs_refresh(current):
+                try:
+                    response = GitlabOAuthClient.get_client().refresh_auth(
+                        current.gitlab_refresh_token
+                    )
+                except Exception:
+                    token_refreshes.inc(outcome="failed")
+                    logger.error(f"Refresh of GitLab token {current.pk} failed")
+                    raise
+                apply_token_response(current, response)
+                current.save(update_fields=TOKEN_FIELDS)
+                token_refreshes.inc(outcome="refreshed")
+        # instance may be shared through config cache, update it in place
+        for field in TOKEN_FIELDS:
+            setattr(gl_oauth_token, field, getattr(current, field))
+
+
+token_manager = TokenManager(settings.GITLAB_TOKEN_REFRESH_MARGIN)
+
+
+def get_access_token(gl_oauth_token: UserGitlabOAuthToken) -> str:
+    return token_manager.get_access_token(gl_oauth_token)
+
+
+def is_unauthorized(error):
+    # requests & httpx errors carry the response, python-gitlab ones the code
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+    return (status_code or getattr(error, "response_code", None)) == 401
+
+
+def with_access_token(gl_oauth_token: UserGitlabOAuthToken, fn):
+    """
+    Calls `fn` with access token of the authorization, when gitlab rejects
+    the token it's refreshed and `fn` is called once more
+    """
+    access_token = get_access_token(gl_oauth_token)
+    try:
+        return fn(access_token)
+    except Exception as e:
+        if not is_unauthorized(e) or not gl_oauth_token.gitlab_refresh_token:
+            raise
+    return fn(token_manager.refresh_rejected(gl_oauth_token, access_token))
+
+
+async def awith_access_token(gl_oauth_token: UserGitlabOAuthToken, coroutine_fn):
+    access_token = await sync_to_async(get_access_token)(gl_oauth_token)
+    try:
+        return await coroutine_fn(access_token)
+    except Exception as e:
+        if not is_unauthorized(e) or not gl_oauth_token.gitlab_refresh_token:
+            raise
+    access_token = await sync_to_async(token_manager.refresh_rejected)(
+        gl_oauth_token, access_token
+    )
+    return await coroutine_fn(access_token)
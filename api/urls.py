@@ -1,10 +1,15 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
+
+# async views only pay off when served by ASGI, WSGI deployments keep sync ones
+pipeline_views = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
-    path("webhooks/gitlab/", views.webhooks_gitlab, name="gitlab_webhooks"),
+    path("webhooks/gitlab/", pipeline_views.webhooks_gitlab, name="gitlab_webhooks"),
     path("oauth/redirect/slack/", views.oauth_slack),
     path("oauth/redirect/gitlab/", views.oauth_gitlab, name="gitlab_oauth"),
-    path("slack/command/", views.slack_command),
-    path("slack/interactive/", views.slack_interactivity),
+    path("slack/command/", pipeline_views.slack_command),
+    path("slack/interactive/", pipeline_views.slack_interactivity),
+    path("metrics/", views.metrics),
 ]
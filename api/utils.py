@@ -1,9 +1,13 @@
+import asyncio
 import logging
-from time import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from functools import wraps
 
 from rest_framework.reverse import reverse
 
+from api.metrics import stage_seconds
+
 logger = logging.getLogger(__name__)
 
 
@@ -33,15 +37,85 @@ def get_gitlab_redirect_uri(request):
 
 
 def measure(func):
+    """
+    Records execution time of func in the stage histogram, stage is named
+    after the function
+    """
+    stage = func.__name__
+
+    if asyncio.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def _atime_it(*args, **kwargs):
+            with stage_seconds.time(stage=stage):
+                return await func(*args, **kwargs)
+
+        return _atime_it
+
     @wraps(func)
     def _time_it(*args, **kwargs):
-        start = int(round(time() * 1000))
-        try:
+        with stage_seconds.time(stage=stage):
             return func(*args, **kwargs)
-        finally:
-            end_ = int(round(time() * 1000)) - start
-            logger.error(
-                f"Total execution time: {end_ if end_ > 0 else 0} ms of {func.__name__}"
-            )
 
     return _time_it
+
+
+_query_counter = ContextVar("query_counter", default=None)
+
+
+class QueryCounter:
+    """
+    Counts queries run while it's active, including those run by threads of
+    sync_to_async, which inherit the context. Queries are counted by the
+    counters it's nested in as well.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.parent = None
+
+    def __enter__(self):
+        self.parent = _query_counter.get()
+        self._token = _query_counter.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _query_counter.reset(self._token)
+
+
+def count_queries(execute, sql, params, many, context):
+    counter = _query_counter.get()
+    while counter is not None:
+        counter.count += 1
+        counter = counter.parent
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_queries)
+
+
+def query_budget(max_queries):
+    """
+    Declares how many queries view may run, checked by QueryBudgetMiddleware
+    """
+
+    def _decorator(view):
+        view.query_budget = max_queries
+        return view
+
+    return _decorator
+
+
+@contextmanager
+def assert_max_queries(max_queries):
+    """
+    Fails when the block runs more than `max_queries` queries
+    """
+    with QueryCounter() as counter:
+        yield counter
+    if counter.count > max_queries:
+        raise AssertionError(
+            f"Expected at most {max_queries} queries, {counter.count} were run"
+        )
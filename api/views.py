@@ -1,71 +1,102 @@
 import json
 import logging
 
-import requests
 from django.conf import settings
-from django.http import JsonResponse
-from gitlab import Gitlab, GitlabAuthenticationError
-from rest_framework import exceptions
+from django.db import close_old_connections
+from django.http import HttpResponse, JsonResponse
+from pydantic import ValidationError as PydanticValidationError
+from rest_framework import exceptions, status
 from rest_framework.decorators import api_view
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 
-from api.data_models import GitlabMRWebhook
+from api.data_models import GitlabMRWebhookView
 from api.destinations.interactions import (
     add_project_to_channel,
+    approve_all_mr_action,
     approve_mr_action,
     view_submission_add_gl_project_to_ch_submit,
     add_gitlab_auth_token,
+    update_view,
     view_submission_add_gitlab_user_auth_submit,
 )
 from api.destinations.messages import (
+    get_approve_list_message,
     get_config_empty_message,
     get_config_project_list,
     get_gl_authorization_empty,
     get_gl_authorization_show,
+    get_view_status,
 )
-from api.destinations.slack import SlackNotifier, slack_oauth_request
+from api.destinations.slack import slack_oauth_request
+from api.config_cache import (
+    get_gitlab_oauth_token,
+    get_repository_mappings,
+    get_slack_user,
+)
+from api.executor import DeduplicatingExecutor
+from api.http import get_session
+from api.jobs import enqueue_webhook
+from api.metrics import current_tenant, registry
 from api.models import SlackUser, GitlabRepoChMapping, UserGitlabOAuthToken
 from api.sources.gitlab import (
     GitlabOAuthClient,
-    GitlabMergeRequest,
+    get_gitlab_api,
+    list_open_merge_requests,
     validate_gitlab_header_event,
     validate_gitlab_header_token,
 )
-from api.utils import get_gitlab_redirect_uri, measure
+from api.tokens import apply_token_response, with_access_token
+from api.utils import get_gitlab_redirect_uri, measure, query_budget
 from gemrabot.redirects import SlackRedirect
 
 logger = logging.getLogger(__name__)
 
+interaction_executor = DeduplicatingExecutor(
+    settings.INTERACTION_WORKERS, settings.INTERACTION_MAX_PENDING
+)
 
-@api_view(["POST"])
-@measure
-def webhooks_gitlab(request: Request):
+
+def get_webhook_project_id(data) -> int:
+    try:
+        return int(data["object_attributes"]["target_project_id"])
+    except (KeyError, TypeError, ValueError):
+        raise exceptions.ValidationError(
+            "Payload is missing object_attributes.target_project_id"
+        )
+
+
+def authenticate_gitlab_webhook(request, data) -> GitlabRepoChMapping:
+    """
+    Checks headers & the token against mappings of the target project
+    before the payload is validated, so junk requests are rejected cheaply
+    """
     validate_gitlab_header_event(request)
 
-    gitlab_mr_webhook: GitlabMRWebhook = GitlabMRWebhook.parse_obj(request.data)
-    gl_mapping: GitlabRepoChMapping = GitlabRepoChMapping.objects.filter(
-        repository_id=gitlab_mr_webhook.object_attributes.target_project_id
-    ).first()
+    gl_mappings = get_repository_mappings(get_webhook_project_id(data))
 
-    if not gl_mapping:
+    if not gl_mappings:
         logger.error("Got request for unknown webhook")
         raise exceptions.ValidationError(
             "No repository registered for given webhook, ignoring"
         )
 
-    validate_gitlab_header_token(request, gl_mapping)
+    gl_mapping = validate_gitlab_header_token(request, gl_mappings)
+    try:
+        GitlabMRWebhookView(data).object_attributes
+    except PydanticValidationError as e:
+        raise exceptions.ValidationError(e.errors())
+    return gl_mapping
 
-    gitlab_oauth_token = gl_mapping.gitlab_oauth_token
-    gitlab_merge_request = GitlabMergeRequest(
-        gitlab_mr_webhook, gitlab_oauth_token.gitlab_access_token
-    )
-    pull_request = gitlab_merge_request.parse()
 
-    slack = SlackNotifier(gl_mapping.slack_user.access_token, gl_mapping.channel_id)
-    slack.notify_of_pull_request(pull_request)
-    return Response({"success": True})
+@query_budget(3)
+@api_view(["POST"])
+@measure
+def webhooks_gitlab(request: Request):
+    gl_mapping = authenticate_gitlab_webhook(request, request.data)
+    enqueue_webhook(gl_mapping, request.data)
+    return Response({"success": True}, status=status.HTTP_202_ACCEPTED)
 
 
 @api_view(["GET"])
@@ -84,18 +115,17 @@ def oauth_slack(request: Request):
 
 @api_view(["GET"])
 def oauth_gitlab(request: Request):
+    from gitlab import GitlabAuthenticationError
+
     code = request.query_params.get("code")
     state = request.query_params.get("state")
     redirect_uri = request.build_absolute_uri(reverse("gitlab_oauth"))
     gitlab_oauth = GitlabOAuthClient.get_client()
     response = gitlab_oauth.complete_auth(code, redirect_uri)
     gl_oauth_token = UserGitlabOAuthToken.objects.get(state_hash=state)
-    gl_oauth_token.gitlab_refresh_token = response["refresh_token"]
-    gl_oauth_token.gitlab_access_token = response["access_token"]
+    apply_token_response(gl_oauth_token, response)
     gl_oauth_token.save()
-    client = Gitlab(
-        settings.GITLAB_HOST, oauth_token=gl_oauth_token.gitlab_access_token
-    )
+    client = get_gitlab_api(oauth_token=gl_oauth_token.gitlab_access_token)
     try:
         client.auth()
     except GitlabAuthenticationError:
@@ -108,27 +138,104 @@ def oauth_gitlab(request: Request):
     return SlackRedirect("slack://open")
 
 
+# first call of a user creates their token row within a savepoint
+@query_budget(7)
 @api_view(["POST"])
 def slack_command(request: Request):
     team_id = request.data.get("team_id")
     user_id = request.data.get("user_id")
-    slack_user = SlackUser.objects.filter(team_id=team_id).first()
-    gl_mappings = GitlabRepoChMapping.objects.filter(slack_user=slack_user).all()
-    gl_auth = UserGitlabOAuthToken.objects.filter(
-        slack_user_id=user_id, slack_team_id=team_id, slack_owner_user=slack_user
-    ).first()
-    if len(gl_mappings) <= 0:
+    if request.data.get("text", "").strip() == "approve":
+        return JsonResponse(defer_approve_list(request.data))
+    return JsonResponse(get_config_message(request, team_id, user_id))
+
+
+def defer_approve_list(data) -> dict:
+    """
+    Listing takes a GitLab call per project, so like interactions it runs in
+    the background and the list is posted to response_url of the command
+    """
+    current_tenant.set(data.get("team_id"))
+    outcome = interaction_executor.submit(
+        data.get("trigger_id"),
+        post_approve_list,
+        data.get("team_id"),
+        data.get("channel_id"),
+        data.get("response_url"),
+    )
+    text = "Looking for open merge requests..."
+    if outcome == "rejected":
+        text = "There is too much going on right now, try again in a moment"
+    return {"response_type": "ephemeral", "text": text}
+
+
+def post_approve_list(team_id, channel_id, response_url):
+    try:
+        message = get_approve_list(team_id, channel_id)
+    except Exception:
+        notify_interaction_failed({"response_url": response_url})
+        raise
+    finally:
+        close_old_connections()
+    get_session(response_url).post(
+        response_url, json={"response_type": "ephemeral", **message}
+    )
+
+
+def get_approve_list(team_id, channel_id):
+    """
+    Lists open MRs of projects posting to the channel, read with tokens of
+    the mappings
+    """
+    current_tenant.set(team_id)
+    slack_user = get_slack_user(team_id)
+    gl_mappings = (
+        GitlabRepoChMapping.objects.filter(slack_user=slack_user, channel_id=channel_id)
+        .select_related("gitlab_oauth_token")
+        .order_by("id")
+    )
+    merge_requests = []
+    for gl_mapping in gl_mappings:
+        if len(merge_requests) >= settings.BULK_APPROVE_MAX_MRS:
+            break
+        limit = settings.BULK_APPROVE_MAX_MRS - len(merge_requests)
+        merge_requests += with_access_token(
+            gl_mapping.gitlab_oauth_token,
+            lambda access_token: list_open_merge_requests(
+                access_token, gl_mapping.repository_id, limit
+            ),
+        )
+    return get_approve_list_message(merge_requests)
+
+
+def get_config_message(request, team_id, user_id, page=0):
+    current_tenant.set(team_id)
+    slack_user = get_slack_user(team_id)
+    page_size = settings.CONFIG_PROJECTS_PAGE_SIZE
+    gl_mappings_qs = GitlabRepoChMapping.objects.filter(slack_user=slack_user)
+    gl_mappings_count = gl_mappings_qs.count()
+    if gl_mappings_count <= 0:
         response = get_config_empty_message()
     else:
-        response = get_config_project_list(gl_mappings)
-    if not gl_auth:
-        redirect_uri = get_gitlab_redirect_uri(request)
-        gl_oauth_token, created = UserGitlabOAuthToken.objects.get_or_create(
-            slack_owner_user=slack_user, slack_user_id=user_id, slack_team_id=team_id
+        gl_mappings = gl_mappings_qs.select_related("gitlab_oauth_token").order_by(
+            "id"
+        )[page * page_size : (page + 1) * page_size]
+        response = get_config_project_list(
+            list(gl_mappings), gl_mappings_count, page, page_size
         )
+    gl_auth = get_gitlab_oauth_token(user_id, team_id, slack_user)
+    if not gl_auth or not gl_auth.gitlab_access_token:
+        if not gl_auth:
+            # concurrent /gemrabot calls race here, the unique constraint
+            # makes the loser read the row created by the winner
+            gl_auth, _ = UserGitlabOAuthToken.objects.get_or_create(
+                slack_owner_user=slack_user,
+                slack_user_id=user_id,
+                slack_team_id=team_id,
+            )
+        redirect_uri = get_gitlab_redirect_uri(request)
         gitlab_oauth = GitlabOAuthClient.get_client()
         oauth_url = gitlab_oauth.get_oauth_redirect_url(
-            redirect_uri, gl_oauth_token.state_hash
+            redirect_uri, gl_auth.state_hash
         )
 
         for block in get_gl_authorization_empty(oauth_url)["blocks"]:
@@ -136,15 +243,69 @@ def slack_command(request: Request):
     else:
         for block in get_gl_authorization_show(gl_auth)["blocks"]:
             response["blocks"].append(block)
-    return JsonResponse(response)
+    return response
 
 
+@query_budget(0)
 @api_view(["POST"])
 def slack_interactivity(request: Request):
     payload = json.loads(request.data.get("payload"))
+    return Response(defer_interaction(request, payload))
+
+
+def defer_interaction(request, payload) -> dict:
+    """
+    Hands the interaction to a background thread and returns ack for Slack,
+    which waits only 3 seconds. Results are delivered through response_url
+    or views.update. Slack retries of a running interaction are dropped.
+    """
+    current_tenant.set(payload["team"]["id"])
+    outcome = interaction_executor.submit(
+        payload["trigger_id"], run_interaction, request, payload
+    )
+    if outcome == "rejected":
+        logger.error("Too many interactions in progress, dropped one")
+    if payload["type"] != "view_submission":
+        return {}
+    title = payload["view"]["title"]["text"]
+    text = "Working on it..."
+    if outcome == "rejected":
+        text = "There is too much going on right now, try again in a moment"
+    return {"response_action": "update", "view": get_view_status(title, text)}
+
+
+def run_interaction(request, payload):
+    try:
+        handle_interaction(request, payload)
+    except Exception:
+        notify_interaction_failed(payload)
+        raise
+    finally:
+        close_old_connections()
+
+
+def notify_interaction_failed(payload):
+    text = "Sorry, something went wrong, please try again"
+    if payload.get("type") == "view_submission":
+        slack_user = get_slack_user(payload["team"]["id"])
+        title = payload["view"]["title"]["text"]
+        update_view(slack_user, payload, get_view_status(title, text))
+    elif payload.get("response_url"):
+        response_url = payload["response_url"]
+        get_session(response_url).post(
+            response_url,
+            json={
+                "replace_original": False,
+                "response_type": "ephemeral",
+                "text": text,
+            },
+        )
+
+
+def handle_interaction(request, payload):
     team_id = payload["team"]["id"]
     trigger_id = payload["trigger_id"]
-    slack_user = SlackUser.objects.filter(team_id=team_id).first()
+    slack_user = get_slack_user(team_id)
     if payload["type"] == "block_actions":
         action_ids = [p["action_id"] for p in payload["actions"]]
         if "add_project_to_channel" in action_ids:
@@ -155,19 +316,13 @@ def slack_interactivity(request: Request):
             return add_gitlab_auth_token(
                 slack_user.access_token, trigger_id, payload["response_url"]
             )
-        if "approve_mr_action" in action_ids:
-            action_name, project_id, pull_request_id = payload["actions"][0][
-                "value"
-            ].split("-")
+        if "approve_mr_action" in action_ids or "approve_all_mr_action" in action_ids:
             user_id = payload["user"]["id"]
-            gl_auth = UserGitlabOAuthToken.objects.filter(
-                slack_user_id=user_id,
-                slack_team_id=team_id,
-                slack_owner_user=slack_user,
-            ).first()
+            response_url = payload["response_url"]
+            gl_auth = get_gitlab_oauth_token(user_id, team_id, slack_user)
             if not gl_auth:
-                requests.post(
-                    payload["response_url"],
+                get_session(response_url).post(
+                    response_url,
                     json={
                         "replace_original": False,
                         "response_type": "ephemeral",
@@ -175,23 +330,33 @@ def slack_interactivity(request: Request):
                     },
                 )
                 logger.error("User not authorized with GL")
-                return Response({})
-            return approve_mr_action(action_name, project_id, pull_request_id, gl_auth)
+                return
+            value = payload["actions"][0]["value"]
+            if "approve_all_mr_action" in action_ids:
+                return approve_all_mr_action(value, gl_auth, response_url)
+            action_name, project_id, pull_request_id = value.split("-")
+            return approve_mr_action(
+                action_name, project_id, pull_request_id, gl_auth, response_url
+            )
+        if "config_projects_page" in action_ids:
+            page = int(payload["actions"][0]["value"])
+            response_url = payload["response_url"]
+            message = get_config_message(request, team_id, payload["user"]["id"], page)
+            get_session(response_url).post(
+                response_url, json={"replace_original": True, **message}
+            )
+            return
         if "add_gl_auth_via_app_to_user" in action_ids:
             # no actions need since its redirect
-            return Response({})
+            return
         if "remove_gl_auth_via_app_to_user" in action_ids:
             user_id = payload["user"]["id"]
-            gl_auth = UserGitlabOAuthToken.objects.filter(
-                slack_user_id=user_id,
-                slack_team_id=team_id,
-                slack_owner_user=slack_user,
-            ).first()
+            gl_auth = get_gitlab_oauth_token(user_id, team_id, slack_user)
             # call revoke authorization
             gitlab_oauth = GitlabOAuthClient.get_client()
             gitlab_oauth.revoke_auth(gl_auth.gitlab_access_token)
             gl_auth.delete()
-            return Response({})
+            return
     if payload["type"] == "view_submission":
         if payload["view"]["callback_id"] == "add_gitlab_project_to_channel_cb":
             gitlab_webhook_uri = request.build_absolute_uri(reverse("gitlab_webhooks"))
@@ -201,5 +366,13 @@ def slack_interactivity(request: Request):
         if payload["view"]["callback_id"] == "add_gitlab_user_auth_cb":
             return view_submission_add_gitlab_user_auth_submit(slack_user, payload)
     logger.error("Unknown interaction has been reached")
-    logger.error(request.data.get("payload"))
-    return Response({})
+    logger.error(payload)
+
+
+def metrics(request):
+    authorization = request.META.get("HTTP_AUTHORIZATION")
+    if settings.METRICS_TOKEN and authorization != f"Bearer {settings.METRICS_TOKEN}":
+        return HttpResponse(status=401)
+    return HttpResponse(
+        registry.expose(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,47 @@
+import logging
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connection
+from requests import RequestException
+
+from api.config_cache import preload_config
+from api.http import get_async_client, get_session
+
+logger = logging.getLogger(__name__)
+
+
+def _warmup_urls():
+    return [url for url in (settings.GITLAB_HOST, settings.SLACK_API_URL) if url]
+
+
+def warm_up():
+    """
+    Opens database connection and pooled connections to GitLab & Slack and
+    loads tenant configuration, so first requests don't pay for it
+    """
+    start = perf_counter()
+    connection.ensure_connection()
+    repositories = preload_config()
+    for url in _warmup_urls():
+        try:
+            # any response leaves a keep-alive connection in the pool
+            get_session(url).head(url, timeout=settings.HTTP_TIMEOUT)
+        except RequestException as e:
+            logger.warning(f"Warm-up connection to {url} failed: {e!r}")
+    logger.info(
+        f"Warmed up in {perf_counter() - start:.3f}s, "
+        f"loaded {repositories} repositories"
+    )
+
+
+async def awarm_up_connections():
+    """
+    Opens connections of the async client of the running event loop
+    """
+    client = get_async_client()
+    for url in _warmup_urls():
+        try:
+            await client.head(url)
+        except Exception as e:
+            logger.warning(f"Warm-up connection to {url} failed: {e!r}")
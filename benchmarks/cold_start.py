@@ -0,0 +1,207 @@
+"""
+Cold start benchmark of the web process. Every run starts a new interpreter
+that sets up Django with given settings, loads the WSGI application and
+sends two webhooks, optionally after the warm-up hook. Reports boot time,
+number of loaded modules and latency of the first & second request:
+
+    python -m benchmarks.cold_start --runs 5 --output cold_start.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.fake_services import FakeGitlab, FakeSlack
+from benchmarks.payloads import merge_request_webhook
+
+VARIANTS = {
+    "default": ("gemrabot.settings", False),
+    "production": ("gemrabot.settings_production", False),
+    "production+warmup": ("gemrabot.settings_production", True),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS)
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=20,
+        help="milliseconds added to every GitLab & Slack response",
+    )
+    parser.add_argument("--output", type=Path)
+    # used by the parent process to measure a single run in a fresh interpreter
+    parser.add_argument("--probe", choices=VARIANTS, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def prepare_database(settings_module, database):
+    """
+    Migrates sqlite database the probes then use, outside of measured time
+    """
+    subprocess.run(
+        [sys.executable, "manage.py", "migrate", "-v", "0", "--skip-checks"],
+        cwd=Path(__file__).resolve().parent.parent,
+        env={
+            **os.environ,
+            "DJANGO_SETTINGS_MODULE": settings_module,
+            "SQLITE_PATH": database,
+        },
+        check=True,
+    )
+
+
+def probe(variant):
+    """
+    Runs in the measured interpreter, everything app related is imported here
+    """
+    start = time.perf_counter()
+    import django
+    from django.core.handlers.wsgi import WSGIHandler
+
+    django.setup()
+    from django.conf import settings
+    from django.test import Client
+    from django.urls import get_resolver
+
+    get_resolver().url_patterns
+    WSGIHandler()
+    boot = time.perf_counter() - start
+
+    from api.models import GitlabRepoChMapping, SlackUser, UserGitlabOAuthToken
+
+    settings.ALLOWED_HOSTS = ["testserver"]
+    slack_user = SlackUser.objects.create(
+        user_id="U1", bot_user_id="B1", team_id="T1", team_name="t", access_token="x"
+    )
+    token = UserGitlabOAuthToken.objects.create(
+        slack_owner_user=slack_user, slack_user_id="U1", slack_team_id="T1"
+    )
+    mapping = GitlabRepoChMapping.objects.create(
+        channel_id="C1",
+        slack_user=slack_user,
+        repository_id=1,
+        repository_name="project-1",
+        gitlab_oauth_token=token,
+    )
+    from django.db import connections
+
+    # the app starts without an open connection or loaded configuration
+    connections.close_all()
+    from api.config_cache import config_cache
+
+    config_cache.invalidate("slack_user", "oauth_token", "mapping")
+
+    warmup = 0
+    if VARIANTS[variant][1]:
+        from api.warmup import warm_up
+
+        start = time.perf_counter()
+        warm_up()
+        warmup = time.perf_counter() - start
+
+    latencies = []
+    for iid in (1, 2):
+        payload = merge_request_webhook(settings.GITLAB_HOST, 1, iid, "opened")
+        start = time.perf_counter()
+        response = Client().post(
+            "/webhooks/gitlab/",
+            json.dumps(payload),
+            content_type="application/json",
+            HTTP_X_GITLAB_EVENT="Merge Request Hook",
+            HTTP_X_GITLAB_TOKEN=str(mapping.webhook_secret),
+        )
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 202, response.content
+    return {
+        "boot_ms": boot * 1000,
+        "warmup_ms": warmup * 1000,
+        "first_request_ms": latencies[0] * 1000,
+        "second_request_ms": latencies[1] * 1000,
+        "modules": len(sys.modules),
+        "gitlab_imported": "gitlab" in sys.modules,
+    }
+
+
+def run_variant(variant, args, gitlab, slack, directory):
+    settings_module = VARIANTS[variant][0]
+    runs = []
+    for index in range(args.runs):
+        database = os.path.join(directory, f"{variant}-{index}.sqlite3")
+        prepare_database(settings_module, database)
+        env = {
+            **os.environ,
+            "DJANGO_SETTINGS_MODULE": settings_module,
+            "SQLITE_PATH": database,
+            "GITLAB_HOST": gitlab.url,
+            "SLACK_API_URL": slack.api_url,
+        }
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.cold_start", "--probe", variant],
+            env=env,
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        result["process_ms"] = (time.perf_counter() - start) * 1000
+        runs.append(result)
+    return {
+        key: (
+            statistics.median(run[key] for run in runs)
+            if isinstance(runs[0][key], (int, float))
+            and not isinstance(runs[0][key], bool)
+            else runs[0][key]
+        )
+        for key in runs[0]
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.probe:
+        print(json.dumps(probe(args.probe)))
+        return
+
+    gitlab = FakeGitlab(args.latency / 1000).start()
+    slack = FakeSlack(args.latency / 1000).start()
+    with tempfile.TemporaryDirectory() as directory:
+        results = {
+            variant: run_variant(variant, args, gitlab, slack, directory)
+            for variant in args.variants
+        }
+    gitlab.stop()
+    slack.stop()
+    report = json.dumps(
+        {
+            "config": {
+                key: str(value) if isinstance(value, Path) else value
+                for key, value in vars(args).items()
+                if key != "probe"
+            },
+            # medians of all runs
+            "results": results,
+            "python": platform.python_version(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        },
+        indent=2,
+    )
+    if args.output:
+        args.output.write_text(report + "\n")
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
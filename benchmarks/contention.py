@@ -0,0 +1,222 @@
+"""
+Database contention benchmark of the storage profiles (DB_PROFILE).
+
+Worker processes read repository mappings and claim & update PrMessage rows
+of a shared set of merge requests at the same time, the way webhook workers
+do. Every operation ends like a request or a job does, so connections are
+reused only when the profile keeps them open:
+
+    python -m benchmarks.contention --profiles sqlite sqlite-wal --workers 8
+    DB_HOST=localhost DB_PASSWORD=... python -m benchmarks.contention --profiles postgres
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.run import summarize
+
+PROFILES = ("sqlite", "sqlite-wal", "postgres")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--profiles", nargs="+", choices=PROFILES, default=["sqlite", "sqlite-wal"]
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=500, help="operations per worker")
+    parser.add_argument("--write-ratio", type=float, default=0.5)
+    parser.add_argument("--repositories", type=int, default=10)
+    parser.add_argument("--merge-requests", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path)
+    # used by the parent process to run a single profile in a fresh interpreter
+    parser.add_argument("--profile", choices=PROFILES, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def setup_django(database):
+    os.environ["DJANGO_SETTINGS_MODULE"] = "gemrabot.settings"
+    os.environ["SQLITE_PATH"] = database
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+    import django
+
+    django.setup()
+    from django.db import connection
+
+    connection.settings_dict["TEST"]["NAME"] = (
+        database if connection.vendor == "sqlite" else None
+    )
+    connection.creation.create_test_db(verbosity=0)
+
+
+def create_mappings(count):
+    from api.models import GitlabRepoChMapping, SlackUser, UserGitlabOAuthToken
+
+    slack_user = SlackUser.objects.create(
+        user_id="U0001",
+        bot_user_id="B0001",
+        team_id="T0001",
+        team_name="team",
+        access_token="xoxb",
+    )
+    token = UserGitlabOAuthToken.objects.create(
+        slack_owner_user=slack_user,
+        slack_user_id=slack_user.user_id,
+        slack_team_id=slack_user.team_id,
+        gitlab_access_token="glpat",
+    )
+    for repository_id in range(1, count + 1):
+        for channel in ("C0001", "C0002"):
+            GitlabRepoChMapping.objects.create(
+                channel_id=channel,
+                slack_user=slack_user,
+                repository_id=repository_id,
+                repository_name=f"project-{repository_id}",
+                gitlab_oauth_token=token,
+            )
+
+
+def read_mappings(repository_id):
+    from api.models import GitlabRepoChMapping
+
+    # same query as api.config_cache.get_repository_mappings loads
+    return list(
+        GitlabRepoChMapping.objects.select_related("gitlab_oauth_token", "slack_user")
+        .filter(repository_id=repository_id)
+        .order_by("id")
+    )
+
+
+def write_pr_message(repository_id, pr_id, channel, ts):
+    """
+    Claims the message of the MR in the channel or updates the posted one,
+    as api.destinations.slack does when it notifies channels
+    """
+    from django.db import IntegrityError, transaction
+    from django.utils import timezone as django_timezone
+
+    from api.models import PrMessage
+
+    try:
+        with transaction.atomic():
+            pr_message = PrMessage.objects.create(
+                message_channel=channel,
+                message_ts="",
+                pr_id=pr_id,
+                repository_id=repository_id,
+                claimed_at=django_timezone.now(),
+            )
+    except IntegrityError:
+        PrMessage.objects.filter(
+            repository_id=repository_id, pr_id=pr_id, message_channel=channel
+        ).update(blocks_hash=ts)
+        return
+    pr_message.message_ts = ts
+    pr_message.save(update_fields=["message_ts"])
+
+
+def work(args, index):
+    from django.db import OperationalError, close_old_connections
+
+    rng = random.Random(args.seed * 1000 + index)
+    latencies = {"read": [], "write": []}
+    errors = 0
+    for op in range(args.ops):
+        repository_id = rng.randint(1, args.repositories)
+        kind = "write" if rng.random() < args.write_ratio else "read"
+        start = time.perf_counter()
+        try:
+            if kind == "write":
+                pr_id = rng.randint(1, args.merge_requests)
+                channel = rng.choice(("C0001", "C0002"))
+                write_pr_message(repository_id, pr_id, channel, f"{index}.{op}")
+            else:
+                read_mappings(repository_id)
+        except OperationalError:
+            errors += 1
+        else:
+            latencies[kind].append(time.perf_counter() - start)
+        close_old_connections()
+    return latencies, errors
+
+
+def run_profile(args):
+    with tempfile.TemporaryDirectory() as directory:
+        setup_django(os.path.join(directory, "contention.sqlite3"))
+        from django.conf import settings
+        from django.db import connection, connections
+
+        create_mappings(args.repositories)
+        # children inherit settings pointing to the test database
+        connections.close_all()
+        start = time.perf_counter()
+        with multiprocessing.get_context("fork").Pool(args.workers) as pool:
+            processed = pool.starmap(
+                work, [(args, index) for index in range(args.workers)]
+            )
+        elapsed = time.perf_counter() - start
+        results = {
+            kind: summarize(
+                [latency for latencies, _ in processed for latency in latencies[kind]],
+                elapsed,
+            )
+            for kind in ("read", "write")
+        }
+        results["errors"] = sum(errors for _, errors in processed)
+        results["ops_per_s"] = args.workers * args.ops / elapsed
+        results["conn_max_age"] = settings.DATABASES["default"].get("CONN_MAX_AGE", 0)
+        connection.creation.destroy_test_db(
+            connection.settings_dict["NAME"], verbosity=0
+        )
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile:
+        print(json.dumps(run_profile(args)))
+        return
+
+    results = {}
+    for profile in args.profiles:
+        # settings pick the profile at import, every profile gets a new process
+        command = [sys.executable, "-m", "benchmarks.contention", "--profile", profile]
+        command += argv if argv is not None else sys.argv[1:]
+        output = subprocess.run(
+            command,
+            env={**os.environ, "DB_PROFILE": profile},
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        results[profile] = json.loads(output.splitlines()[-1])
+    report = json.dumps(
+        {
+            "config": {
+                key: str(value) if isinstance(value, Path) else value
+                for key, value in vars(args).items()
+                if key != "profile"
+            },
+            "results": results,
+            "python": platform.python_version(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        },
+        indent=2,
+    )
+    if args.output:
+        args.output.write_text(report + "\n")
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+from benchmarks.payloads import diffs_count, diffs_page_body
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, so connection pooling of the app is exercised
+    protocol_version = "HTTP/1.1"
+    # headers & body are written separately, don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        service = self.server.service
+        status, headers, content = service.dispatch(self.command, self.path, body)
+        if service.latency:
+            time.sleep(service.latency)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeService:
+    """
+    HTTP server running in a background thread of the benchmark process,
+    every response is delayed by `latency` seconds. Subclasses define
+    `routes` as (method, path regex, handler name), handlers get request
+    body, query parameters and groups of the path regex.
+    """
+
+    routes = ()
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.service = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def dispatch(self, method, path, body):
+        path, _, query = path.partition("?")
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                with self._lock:
+                    self.calls[handler] += 1
+                return getattr(self, handler)(
+                    body, dict(parse_qsl(query)), *match.groups()
+                )
+        with self._lock:
+            self.calls["not_found"] += 1
+        return 404, {}, b""
+
+    @staticmethod
+    def json(value, status=200, headers=None):
+        return (
+            status,
+            {"Content-Type": "application/json", **(headers or {})},
+            json.dumps(value).encode(),
+        )
+
+
+class FakeGitlab(FakeService):
+    """
+    Serves the parts of GitLab REST API read by the webhook pipeline for merge
+    requests registered with `add_merge_request`
+    """
+
+    routes = (
+        ("GET", r"/api/v4/users/(\d+)", "user"),
+        ("GET", r"/api/v4/projects/(\d+)", "project"),
+        ("GET", r"/api/v4/projects/(\d+)/merge_requests/(\d+)", "merge_request"),
+        ("GET", r"/api/v4/projects/(\d+)/merge_requests/(\d+)/diffs", "diffs"),
+        ("GET", r"/api/v4/projects/(\d+)/merge_requests/(\d+)/approvals", "approvals"),
+    )
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.merge_requests = {}
+
+    def add_merge_request(self, project_id, iid, size):
+        """
+        `size` is one of benchmarks.payloads.DIFF_SIZES, pages of diffs are
+        serialized once and shared by every merge request of that size
+        """
+        self.merge_requests[(int(project_id), int(iid))] = size
+
+    def user(self, body, query, user_id):
+        return self.json(
+            {
+                "id": int(user_id),
+                "name": f"Author {user_id}",
+                "username": f"author{user_id}",
+                "web_url": f"{self.url}/author{user_id}",
+            }
+        )
+
+    def project(self, body, query, project_id):
+        return self.json({"id": int(project_id), "name": f"project-{project_id}"})
+
+    def merge_request(self, body, query, project_id, iid):
+        return self.json(
+            {
+                "iid": int(iid),
+                "project_id": int(project_id),
+                "closed_by": {"name": "Closer"},
+                "merged_by": {"name": "Merger"},
+                "created_at": "2020-10-01T10:00:00.000Z",
+                "merged_at": "2020-10-02T12:30:00.000Z",
+            }
+        )
+
+    def diffs(self, body, query, project_id, iid):
+        size = self.merge_requests.get((int(project_id), int(iid)))
+        if size is None:
+            return 404, {}, b""
+        page = int(query.get("page", 1))
+        per_page = int(query.get("per_page", 20))
+        total = diffs_count(size)
+        pages = max((total + per_page - 1) // per_page, 1)
+        headers = {
+            "Content-Type": "application/json",
+            "X-Page": str(page),
+            "X-Per-Page": str(per_page),
+            "X-Total": str(total),
+            "X-Total-Pages": str(pages),
+            "X-Next-Page": str(page + 1) if page < pages else "",
+        }
+        return 200, headers, diffs_page_body(size, page, per_page)
+
+    def approvals(self, body, query, project_id, iid):
+        return self.json({"approved_by": [{"user": {"name": "Reviewer"}}]})
+
+
+class FakeSlack(FakeService):
+    """
+    Slack Web API methods used by the app under /api/ and response_url
+    endpoints under /response/
+    """
+
+    routes = (
+        ("POST", r"/api/(chat\.postMessage|chat\.update)", "chat"),
+        ("POST", r"/api/(views\.open|views\.update)", "views"),
+        ("POST", r"/response/(\w+)", "response_url"),
+    )
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self._ts = 0
+
+    @property
+    def api_url(self):
+        return f"{self.url}/api"
+
+    def response_url(self, body, query, key):
+        return 200, {"Content-Type": "text/plain"}, b"ok"
+
+    def chat(self, body, query, method):
+        message = json.loads(body or b"{}")
+        with self._lock:
+            self._ts += 1
+            ts = f"{self._ts}.000100"
+        return self.json(
+            {"ok": True, "channel": message.get("channel"), "ts": message.get("ts", ts)}
+        )
+
+    def views(self, body, query, method):
+        return self.json({"ok": True, "view": {"id": "V0000"}})
@@ -0,0 +1,176 @@
+import json
+import random
+from functools import lru_cache
+
+# (files, changed lines per file)
+DIFF_SIZES = {
+    "small": (2, 6),
+    "large": (40, 120),
+    "huge": (400, 600),
+}
+# hook action per event, updated are pushes & edits of an opened MR
+ACTIONS = {"opened": "open", "updated": "update", "merged": "merge", "closed": "close"}
+EVENTS = tuple(ACTIONS)
+# share of events when they are mixed
+EVENT_WEIGHTS = (0.45, 0.25, 0.2, 0.1)
+
+
+def _file_diff(index, lines):
+    removed = lines // 3
+    added = lines - removed
+    hunk = [f"@@ -1,{removed + 3} +1,{added + 3} @@ def function_{index}():"]
+    hunk.extend(f"-    value = compute_old({i})" for i in range(removed))
+    hunk.extend(f"+    value = compute_new({i}, retries=3)" for i in range(added))
+    hunk.extend(["     return value", " ", " "])
+    return "\n".join(hunk) + "\n"
+
+
+def diffs_count(size):
+    return DIFF_SIZES[size][0]
+
+
+@lru_cache(maxsize=None)
+def diffs_page_body(size, page, per_page):
+    """
+    Serialized page of /merge_requests/:iid/diffs with given diff size
+    """
+    files, lines = DIFF_SIZES[size]
+    diffs = []
+    for index in range((page - 1) * per_page, min(page * per_page, files)):
+        path = f"src/module_{index // 20}/file_{index}.py"
+        diffs.append(
+            {
+                "old_path": path,
+                "new_path": path,
+                "a_mode": "100644",
+                "b_mode": "100644",
+                "new_file": index % 10 == 1,
+                "renamed_file": False,
+                "deleted_file": index % 10 == 2,
+                "diff": _file_diff(index, lines),
+            }
+        )
+    return json.dumps(diffs).encode()
+
+
+def _project(gitlab_url, project_id):
+    name = f"project-{project_id}"
+    web_url = f"{gitlab_url}/group/{name}"
+    return {
+        "id": project_id,
+        "name": name,
+        "description": "Benchmark project",
+        "web_url": web_url,
+        "avatar_url": None,
+        "git_ssh_url": f"git@localhost:group/{name}.git",
+        "git_http_url": f"{web_url}.git",
+        "namespace": "group",
+        "visibility_level": 0,
+        "path_with_namespace": f"group/{name}",
+        "default_branch": "master",
+        "homepage": web_url,
+        "url": f"git@localhost:group/{name}.git",
+        "ssh_url": f"git@localhost:group/{name}.git",
+        "http_url": f"{web_url}.git",
+    }
+
+
+def merge_request_webhook(gitlab_url, project_id, iid, event, author_id=1):
+    """
+    Returns payload of GitLab "Merge Request Hook" the way GitLab sends it
+    """
+    state = "opened" if event == "updated" else event
+    project = _project(gitlab_url, project_id)
+    user = {
+        "name": f"Author {author_id}",
+        "username": f"author{author_id}",
+        "email": None,
+        "avatar_url": None,
+    }
+    return {
+        "object_kind": "merge_request",
+        "event_type": "merge_request",
+        "user": user,
+        "project": project,
+        "repository": {
+            "name": project["name"],
+            "url": project["url"],
+            "description": project["description"],
+            "homepage": project["homepage"],
+        },
+        "object_attributes": {
+            "id": project_id * 100000 + iid,
+            "iid": iid,
+            "target_branch": "master",
+            "source_branch": f"feature/change-{iid}",
+            "source_project_id": project_id,
+            "target_project_id": project_id,
+            "author_id": author_id,
+            "assignee_id": None,
+            "title": f"Change number {iid} of {project['name']}",
+            "description": "Refactors the computation and adds retries.\n" * 5,
+            "created_at": "2020-10-01 10:00:00 UTC",
+            "updated_at": "2020-10-02 12:30:00 UTC",
+            "milestone_id": None,
+            "state": state,
+            "merge_status": "can_be_merged",
+            "source": project,
+            "target": project,
+            "last_commit": {
+                "id": f"{iid:040x}",
+                "message": "Add retries to computation",
+                "timestamp": "2020-10-02T12:00:00+00:00",
+                "url": f"{project['web_url']}/-/commit/{iid:040x}",
+                "author": user,
+            },
+            "work_in_progress": False,
+            "url": f"{project['web_url']}/-/merge_requests/{iid}",
+            "action": ACTIONS[event],
+            "assignee": None,
+        },
+        "labels": [],
+        "changes": {"updated_at": {"previous": None, "current": "2020-10-02"}},
+    }
+
+
+def generate_events(count, project_ids, diff="mixed", event="mixed", seed=0):
+    """
+    Yields (project_id, iid, event, diff size) of `count` webhook events
+    spread over given projects. Updates, merges & closes are sent for merge
+    requests opened earlier in the run when there are any.
+    """
+    rng = random.Random(seed)
+    opened = []
+    next_iid = {project_id: 1 for project_id in project_ids}
+    for _ in range(count):
+        kind = event
+        if event == "mixed":
+            kind = rng.choices(EVENTS, EVENT_WEIGHTS)[0]
+        size = diff
+        if diff == "mixed":
+            size = rng.choices(("small", "large", "huge"), (0.7, 0.25, 0.05))[0]
+        if kind in ("merged", "closed") and opened:
+            project_id, iid, size = opened.pop(rng.randrange(len(opened)))
+        elif kind == "updated" and opened:
+            project_id, iid, size = rng.choice(opened)
+        else:
+            project_id = rng.choice(project_ids)
+            iid = next_iid[project_id]
+            next_iid[project_id] += 1
+            if kind in ("opened", "updated"):
+                opened.append((project_id, iid, size))
+        yield project_id, iid, kind, size
+
+
+def block_action_payload(team_id, user_id, action_id, response_url, trigger_id):
+    """
+    Returns Slack interactivity payload of a button click in a message
+    """
+    return {
+        "type": "block_actions",
+        "team": {"id": team_id, "domain": "benchmark"},
+        "user": {"id": user_id, "team_id": team_id},
+        "trigger_id": trigger_id,
+        "response_url": response_url,
+        "actions": [{"action_id": action_id, "block_id": "b", "type": "button"}],
+    }
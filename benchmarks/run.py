@@ -0,0 +1,378 @@
+"""
+End-to-end benchmark of the webhook & Slack interactivity endpoints.
+
+The app runs in-process against fake GitLab and Slack servers (see
+fake_services), events are sent with django test clients at given
+concurrency and queued webhooks are then processed the same way run_worker
+does. Results are written as JSON so runs can be compared:
+
+    python -m benchmarks.run --events 500 --concurrency 20 --output before.json
+    python -m benchmarks.run --mode async --events 500 --output after.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import urlencode
+
+from benchmarks.fake_services import FakeGitlab, FakeSlack
+from benchmarks.payloads import (
+    block_action_payload,
+    generate_events,
+    merge_request_webhook,
+)
+
+# rejected sends webhooks with wrong token or for unknown projects
+SCENARIOS = ("webhook", "rejected", "interaction")
+EXPECTED_STATUS = {"webhook": 202, "rejected": 400, "interaction": 200}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenario", choices=SCENARIOS, default="webhook")
+    parser.add_argument(
+        "--mode",
+        choices=("sync", "async"),
+        default="sync",
+        help="sync views & threaded worker or async views & asyncio worker",
+    )
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--tenants", type=int, default=10)
+    parser.add_argument(
+        "--diff", choices=("small", "large", "huge", "mixed"), default="mixed"
+    )
+    parser.add_argument(
+        "--event",
+        choices=("opened", "updated", "merged", "closed", "mixed"),
+        default="mixed",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=20,
+        help="milliseconds added to every GitLab & Slack response",
+    )
+    parser.add_argument(
+        "--slack-pacing",
+        action="store_true",
+        help="keep Slack rate limiting on, by default it's disabled so the "
+        "benchmark measures the app rather than the pacing",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path)
+    return parser.parse_args(argv)
+
+
+def setup_django(args, gitlab, slack, database):
+    os.environ["DJANGO_SETTINGS_MODULE"] = "gemrabot.settings"
+    os.environ["GITLAB_HOST"] = gitlab.url
+    os.environ["SLACK_API_URL"] = slack.api_url
+    os.environ["ASYNC_VIEWS"] = "true" if args.mode == "async" else "false"
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+    import django
+
+    django.setup()
+    from django.conf import settings
+    from django.db import connection
+
+    settings.ALLOWED_HOSTS = ["testserver"]
+    settings.DEBUG = False
+    settings.WEBHOOK_COALESCE_WINDOW = 0
+    if not args.slack_pacing:
+        settings.SLACK_METHOD_RATE_LIMITS = {}
+        settings.SLACK_CHANNEL_RATE_METHODS = set()
+    connection.settings_dict["TEST"]["NAME"] = database
+    connection.creation.create_test_db(verbosity=0)
+
+
+def create_tenants(count):
+    from api.models import GitlabRepoChMapping, SlackUser, UserGitlabOAuthToken
+
+    tenants = []
+    for index in range(1, count + 1):
+        slack_user = SlackUser.objects.create(
+            user_id=f"U{index:04}",
+            bot_user_id=f"B{index:04}",
+            team_id=f"T{index:04}",
+            team_name=f"team-{index}",
+            access_token=f"xoxb-{index}",
+        )
+        token = UserGitlabOAuthToken.objects.create(
+            slack_owner_user=slack_user,
+            slack_user_id=slack_user.user_id,
+            slack_team_id=slack_user.team_id,
+            gitlab_access_token=f"glpat-{index}",
+        )
+        tenants.append(
+            GitlabRepoChMapping.objects.create(
+                channel_id=f"C{index:04}",
+                slack_user=slack_user,
+                repository_id=index,
+                repository_name=f"project-{index}",
+                gitlab_oauth_token=token,
+            )
+        )
+    return tenants
+
+
+def build_requests(args, tenants, gitlab, slack):
+    """
+    Returns (path, kwargs for client.post, headers) of every event of the run
+    """
+    requests = []
+    if args.scenario in ("webhook", "rejected"):
+        mappings = {mapping.repository_id: mapping for mapping in tenants}
+        events = generate_events(
+            args.events, list(mappings), args.diff, args.event, args.seed
+        )
+        for index, (project_id, iid, event, size) in enumerate(events):
+            gitlab.add_merge_request(project_id, iid, size)
+            token = str(mappings[project_id].webhook_secret)
+            if args.scenario == "rejected" and index % 2:
+                token = "not-the-secret"
+            elif args.scenario == "rejected":
+                project_id += len(mappings)
+            payload = merge_request_webhook(gitlab.url, project_id, iid, event)
+            requests.append(
+                (
+                    "/webhooks/gitlab/",
+                    {"data": json.dumps(payload), "content_type": "application/json"},
+                    {"X-Gitlab-Event": "Merge Request Hook", "X-Gitlab-Token": token},
+                )
+            )
+    else:
+        for index in range(args.events):
+            mapping = tenants[index % len(tenants)]
+            payload = block_action_payload(
+                mapping.slack_user.team_id,
+                mapping.slack_user.user_id,
+                "add_project_to_channel",
+                f"{slack.url}/response/{index}",
+                f"{index}.{args.seed}",
+            )
+            # slack posts interactions form encoded
+            data = urlencode({"payload": json.dumps(payload)})
+            content_type = "application/x-www-form-urlencoded"
+            requests.append(
+                (
+                    "/slack/interactive/",
+                    {"data": data, "content_type": content_type},
+                    {},
+                )
+            )
+    return requests
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    return {
+        "p50_ms": percentile(50) * 1000,
+        "p95_ms": percentile(95) * 1000,
+        "p99_ms": percentile(99) * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def summarize(latencies, elapsed, failures=0):
+    return {
+        "count": len(latencies),
+        "failures": failures,
+        "elapsed_s": elapsed,
+        "rps": len(latencies) / elapsed if elapsed else 0,
+        **percentiles(latencies),
+    }
+
+
+def send_sync(requests, concurrency):
+    from django.test import Client
+
+    def send(request):
+        path, kwargs, headers = request
+        # test client takes headers as WSGI environ keys
+        environ = {
+            "HTTP_" + name.upper().replace("-", "_"): value
+            for name, value in headers.items()
+        }
+        start = time.perf_counter()
+        response = Client().post(path, **kwargs, **environ)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as e:
+        results = list(e.map(send, requests))
+    return results, time.perf_counter() - start
+
+
+async def send_async(requests, concurrency):
+    from django.test import AsyncClient
+
+    semaphore = asyncio.Semaphore(concurrency)
+    client = AsyncClient()
+
+    async def send(request):
+        path, kwargs, headers = request
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(path, **kwargs, **headers)
+            return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[send(request) for request in requests])
+    return results, time.perf_counter() - start
+
+
+def process_sync(workers):
+    from django.db import close_old_connections
+
+    from api.executor import PartitionedExecutor
+    from api.jobs import claim_next_job, run_job
+
+    def timed_run(job):
+        close_old_connections()
+        start = time.perf_counter()
+        ok = run_job(job)
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    executor = PartitionedExecutor(workers)
+    futures = []
+    while True:
+        job = claim_next_job("benchmark")
+        if job is None:
+            break
+        key = (job.repository_id, job.pr_id)
+        futures.append(executor.submit(key, timed_run, job))
+    executor.shutdown()
+    close_old_connections()
+    return [future.result() for future in futures], time.perf_counter() - start
+
+
+async def process_async(workers):
+    from asgiref.sync import sync_to_async
+
+    from api.executor import AsyncPartitionedExecutor
+    from api.http import get_async_client
+    from api.jobs import arun_job, claim_next_job
+
+    async def timed_run(job):
+        start = time.perf_counter()
+        ok = await arun_job(job)
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    executor = AsyncPartitionedExecutor(workers)
+    futures = []
+    while True:
+        job = await sync_to_async(claim_next_job)("benchmark")
+        if job is None:
+            break
+        key = (job.repository_id, job.pr_id)
+        futures.append(executor.submit(key, timed_run, job))
+    await executor.shutdown()
+    await get_async_client().aclose()
+    return [future.result() for future in futures], time.perf_counter() - start
+
+
+def outbound_calls(gitlab, slack, events):
+    return {
+        "gitlab": dict(gitlab.calls),
+        "slack": dict(slack.calls),
+        "gitlab_per_event": gitlab.total_calls() / events if events else 0,
+        "slack_per_event": slack.total_calls() / events if events else 0,
+    }
+
+
+def run(args):
+    gitlab = FakeGitlab(args.latency / 1000).start()
+    slack = FakeSlack(args.latency / 1000).start()
+    with tempfile.TemporaryDirectory() as directory:
+        setup_django(args, gitlab, slack, os.path.join(directory, "benchmark.sqlite3"))
+        tenants = create_tenants(args.tenants)
+        requests = build_requests(args, tenants, gitlab, slack)
+
+        if args.mode == "async":
+            responses, elapsed = asyncio.run(send_async(requests, args.concurrency))
+        else:
+            responses, elapsed = send_sync(requests, args.concurrency)
+        expected = EXPECTED_STATUS[args.scenario]
+        results = {
+            "requests": summarize(
+                [latency for latency, _ in responses],
+                elapsed,
+                sum(status != expected for _, status in responses),
+            ),
+            "requests_outbound": outbound_calls(gitlab, slack, len(requests)),
+        }
+
+        if args.scenario == "interaction":
+            from api.views import interaction_executor
+
+            # requests are only acked, the work runs in the background
+            start = time.perf_counter()
+            interaction_executor.wait()
+            results["interactions_drain_s"] = time.perf_counter() - start
+            results["requests_outbound"] = outbound_calls(gitlab, slack, len(requests))
+
+        if args.scenario == "webhook":
+            from api.metrics import slack_updates_skipped
+
+            gitlab.reset_calls()
+            slack.reset_calls()
+            if args.mode == "async":
+                processed, elapsed = asyncio.run(process_async(args.workers))
+            else:
+                processed, elapsed = process_sync(args.workers)
+            results["jobs"] = summarize(
+                [latency for latency, _ in processed],
+                elapsed,
+                sum(not ok for _, ok in processed),
+            )
+            results["jobs_outbound"] = outbound_calls(gitlab, slack, len(requests))
+            results["slack_updates_skipped"] = sum(
+                value for _, _, value in slack_updates_skipped.samples()
+            )
+
+    gitlab.stop()
+    slack.stop()
+    return {
+        "scenario": args.scenario,
+        "config": {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(args).items()
+        },
+        "results": results,
+        # includes the fake servers running in the same process
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "python": platform.python_version(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        args.output.write_text(report + "\n")
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
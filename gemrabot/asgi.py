@@ -8,9 +8,20 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 """
 
 import os
+import threading
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "gemrabot.settings")
 
 application = get_asgi_application()
+
+if settings.WARMUP:
+    from api.warmup import warm_up
+
+    # servers may import the application inside a running event loop, where
+    # database access isn't allowed
+    warmup_thread = threading.Thread(target=warm_up)
+    warmup_thread.start()
+    warmup_thread.join()
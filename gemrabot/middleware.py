@@ -1,3 +1,11 @@
+import asyncio
+import logging
+
+from api.utils import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+
 # https://stackoverflow.com/questions/59928127/let-django-use-the-x-original-host-header-to-setup-absolute-urls
 # Used with expose which uses x_original_host instead
 class MultipleProxyMiddleware:
@@ -6,9 +14,16 @@ class MultipleProxyMiddleware:
         "HTTP_X_FORWARDED_HOST",
         "HTTP_X_FORWARDED_SERVER",
     ]
+    # only rewrites headers, so async views are called without a thread hop
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # makes django treat __call__ as coroutine function, it returns
+            # the coroutine of the next handler
+            self._is_coroutine = asyncio.coroutines._is_coroutine
 
     def __call__(self, request):
         """
@@ -28,3 +43,43 @@ class MultipleProxyMiddleware:
             request.META["HTTP_X_FORWARDED_HOST"] = request.META["HTTP_X_ORIGINAL_HOST"]
 
         return self.get_response(request)
+
+
+class QueryBudgetMiddleware:
+    """
+    Counts queries run while handling request and flags views exceeding
+    the budget declared with api.utils.query_budget
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        with QueryCounter() as counter:
+            response = self.get_response(request)
+        return self.check_budget(request, counter, response)
+
+    async def __acall__(self, request):
+        with QueryCounter() as counter:
+            response = await self.get_response(request)
+        return self.check_budget(request, counter, response)
+
+    @staticmethod
+    def check_budget(request, counter, response):
+        budget = getattr(request, "query_budget", None)
+        if budget is not None and counter.count > budget:
+            logger.error(
+                f"{request.path} ran {counter.count} queries, budget is {budget}"
+            )
+            response["X-Query-Budget-Exceeded"] = f"{counter.count}/{budget}"
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = getattr(view_func, "query_budget", None)
@@ -41,7 +41,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     "rest_framework",
-    "api",
+    "api.apps.ApiConfig",
 ]
 
 MIDDLEWARE = [
@@ -53,6 +53,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "gemrabot.middleware.QueryBudgetMiddleware",
 ]
 
 ROOT_URLCONF = "gemrabot.urls"
@@ -82,12 +83,39 @@ WSGI_APPLICATION = "gemrabot.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# "sqlite" (default), "sqlite-wal" for several worker processes sharing one
+# sqlite file or "postgres"
+DB_PROFILE = os.getenv("DB_PROFILE", "sqlite")
+# seconds a connection is kept open and reused by following requests
+DB_CONN_MAX_AGE = int(os.getenv("DB_CONN_MAX_AGE", 60))
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": os.getenv("SQLITE_PATH", BASE_DIR / "db.sqlite3"),
     }
 }
+# applied to every new sqlite connection
+SQLITE_PRAGMAS = {}
+
+if DB_PROFILE == "sqlite-wal":
+    # readers don't block the writer, writers wait for each other up to
+    # the timeout instead of failing with "database is locked"
+    DATABASES["default"]["OPTIONS"] = {
+        "timeout": float(os.getenv("SQLITE_BUSY_TIMEOUT", 20))
+    }
+    DATABASES["default"]["CONN_MAX_AGE"] = DB_CONN_MAX_AGE
+    SQLITE_PRAGMAS = {"journal_mode": "WAL", "synchronous": "NORMAL"}
+elif DB_PROFILE == "postgres":
+    DATABASES["default"] = {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.getenv("DB_NAME", "gemrabot"),
+        "USER": os.getenv("DB_USER", "gemrabot"),
+        "PASSWORD": os.getenv("DB_PASSWORD", ""),
+        "HOST": os.getenv("DB_HOST", "localhost"),
+        "PORT": os.getenv("DB_PORT", "5432"),
+        "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+    }
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -128,7 +156,88 @@ STATIC_URL = "/static/"
 SLACK_WEBHOOK_URL = os.getenv("SLACK_WEBHOOK_URL")
 SLACK_CLIENT_ID = os.getenv("SLACK_CLIENT_ID")
 SLACK_CLIENT_SECRET = os.getenv("SLACK_CLIENT_SECRET")
+SLACK_API_URL = os.getenv("SLACK_API_URL", "https://slack.com/api")
 GITLAB_API_KEY = os.getenv("GITLAB_API_KEY")
 GITLAB_APP_ID = os.getenv("GITLAB_APP_ID")
 GITLAB_APP_SECRET = os.getenv("GITLAB_APP_SECRET")
 GITLAB_HOST = os.getenv("GITLAB_HOST")
+# seconds before expiry an oauth access token is refreshed
+GITLAB_TOKEN_REFRESH_MARGIN = int(os.getenv("GITLAB_TOKEN_REFRESH_MARGIN", 300))
+
+JOB_QUEUE_WORKERS = int(os.getenv("JOB_QUEUE_WORKERS", 4))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 300))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", 5))
+WEBHOOK_COALESCE_WINDOW = float(os.getenv("WEBHOOK_COALESCE_WINDOW", 2))
+
+GITLAB_CACHE_BACKEND = "api.sources.cache.LRUResponseCache"
+GITLAB_CACHE_OPTIONS = {"max_entries": int(os.getenv("GITLAB_CACHE_MAX_ENTRIES", 1024))}
+# seconds a cached response is served without asking gitlab, 0 disables caching
+GITLAB_CACHE_TTLS = {
+    "user": int(os.getenv("GITLAB_CACHE_USER_TTL", 3600)),
+    "project": int(os.getenv("GITLAB_CACHE_PROJECT_TTL", 600)),
+}
+
+# keep-alive connections kept per remote host and number of hosts pooled
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 10))
+HTTP_POOL_MAX_HOSTS = int(os.getenv("HTTP_POOL_MAX_HOSTS", 16))
+# seconds to wait for connection & response of gitlab and slack calls
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10))
+# retries of idempotent gitlab GETs, delays grow exponentially with full jitter
+GITLAB_GET_RETRIES = int(os.getenv("GITLAB_GET_RETRIES", 2))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", 0.2))
+HTTP_RETRY_MAX_BACKOFF = float(os.getenv("HTTP_RETRY_MAX_BACKOFF", 2))
+# consecutive failures of a host that open its circuit & seconds it stays open
+CIRCUIT_BREAKER_FAILURES = int(os.getenv("CIRCUIT_BREAKER_FAILURES", 5))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.getenv("CIRCUIT_BREAKER_RESET_TIMEOUT", 30))
+
+# MRs with up to this many changed lines are shown with full diff in slack
+INLINE_DIFF_MAX_LINES = int(os.getenv("INLINE_DIFF_MAX_LINES", 20))
+# number of files listed in the summary of bigger MRs
+SUMMARY_MAX_FILES = int(os.getenv("SUMMARY_MAX_FILES", 10))
+# characters of file sections in a message, files past it are only counted
+SLACK_MESSAGE_MAX_CHARS = int(os.getenv("SLACK_MESSAGE_MAX_CHARS", 12000))
+# MR diffs are read in pages of this many files, once the read pages reach
+# either cap the rest isn't fetched and its files are only counted in the summary
+GITLAB_DIFF_PAGE_SIZE = int(os.getenv("GITLAB_DIFF_PAGE_SIZE", 20))
+GITLAB_DIFF_MAX_BYTES = int(os.getenv("GITLAB_DIFF_MAX_BYTES", 1024 * 1024))
+GITLAB_DIFF_MAX_FILES = int(os.getenv("GITLAB_DIFF_MAX_FILES", 100))
+
+# serve webhooks & slack endpoints with async views, meant for ASGI deployments
+ASYNC_VIEWS = os.getenv("ASYNC_VIEWS", "false").lower() == "true"
+HTTP_ASYNC_MAX_CONNECTIONS = int(os.getenv("HTTP_ASYNC_MAX_CONNECTIONS", 100))
+
+# (requests per second, burst) for slack web api methods per workspace
+SLACK_METHOD_RATE_LIMITS = {
+    "chat.postMessage": (1, 10),
+    "chat.update": (0.8, 10),
+    "views.open": (1.5, 20),
+    "views.update": (1.5, 20),
+}
+# slack allows roughly one message per second in a channel
+SLACK_CHANNEL_RATE_LIMIT = (1, 3)
+SLACK_CHANNEL_RATE_METHODS = {"chat.postMessage", "chat.update"}
+SLACK_RATE_LIMIT_RETRIES = int(os.getenv("SLACK_RATE_LIMIT_RETRIES", 3))
+
+# in-process cache of slack workspaces, gitlab tokens and repository mappings
+CONFIG_CACHE_MAX_ENTRIES = int(os.getenv("CONFIG_CACHE_MAX_ENTRIES", 4096))
+# changes made by other processes are picked up after this many seconds
+CONFIG_CACHE_TTL = int(os.getenv("CONFIG_CACHE_TTL", 60))
+
+# projects listed per page of /gemrabot, slack allows up to 50 blocks in a message
+CONFIG_PROJECTS_PAGE_SIZE = int(os.getenv("CONFIG_PROJECTS_PAGE_SIZE", 20))
+# open MRs listed by `/gemrabot approve` and how many of them are approved at once
+BULK_APPROVE_MAX_MRS = int(os.getenv("BULK_APPROVE_MAX_MRS", 20))
+BULK_APPROVE_CONCURRENCY = int(os.getenv("BULK_APPROVE_CONCURRENCY", 4))
+# slack interactions are acked right away and handled by these background
+# threads, interactions past INTERACTION_MAX_PENDING are dropped
+INTERACTION_WORKERS = int(os.getenv("INTERACTION_WORKERS", 4))
+INTERACTION_MAX_PENDING = int(os.getenv("INTERACTION_MAX_PENDING", 500))
+
+# open connections to gitlab, slack & database and load tenant configuration
+# when web or worker process starts
+WARMUP = os.getenv("GEMRABOT_WARMUP", "false").lower() == "true"
+
+# when set, /metrics/ requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
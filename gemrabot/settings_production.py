@@ -0,0 +1,36 @@
+"""
+Settings for serving the webhook & slack endpoints and running workers. Only
+apps and middleware these need are loaded, admin, sessions, messages & CSRF
+are left out as no endpoint uses them:
+
+    DJANGO_SETTINGS_MODULE=gemrabot.settings_production
+"""
+
+import os
+
+from gemrabot.settings import *  # noqa: F401,F403
+
+DEBUG = os.getenv("DJANGO_DEBUG", "false").lower() == "true"
+
+INSTALLED_APPS = [
+    "rest_framework",
+    "api.apps.ApiConfig",
+]
+
+MIDDLEWARE = [
+    "gemrabot.middleware.MultipleProxyMiddleware",
+    "django.middleware.security.SecurityMiddleware",
+    "django.middleware.common.CommonMiddleware",
+    "gemrabot.middleware.QueryBudgetMiddleware",
+]
+
+TEMPLATES = []
+
+AUTH_PASSWORD_VALIDATORS = []
+
+# requests are authenticated by webhook secrets & slack payloads, not users
+REST_FRAMEWORK = {
+    "DEFAULT_AUTHENTICATION_CLASSES": [],
+    "DEFAULT_RENDERER_CLASSES": ["rest_framework.renderers.JSONRenderer"],
+    "UNAUTHENTICATED_USER": None,
+}